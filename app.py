@@ -1,15 +1,34 @@
 import streamlit as st
 import requests
 import base64
+import cProfile
+import difflib
+import hashlib
 import io
+import os
 import time # <---NEW
 import pandas as pd
 import gspread
 from google.oauth2.service_account import Credentials
 from google import genai
+from PIL import Image
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import json
+import marshal
+import pstats
+import sys
+import threading
+import re
+import socket
+import sqlite3
+import tempfile
+import urllib.parse
 import uuid
 import time
+from abc import ABC, abstractmethod
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
 from datetime import datetime, date
 
 # -----------------------------------------------------------------------------
@@ -45,6 +64,110 @@ def safe_int(val, default=0):
     except (ValueError, TypeError):
         return default
 
+# -----------------------------------------------------------------------------
+# 1.6. DOMAIN MODELS
+# -----------------------------------------------------------------------------
+# Sheet records are coerced once, when they are read, into these slotted
+# dataclasses. Render code works with the parsed numbers directly.
+
+NUTRIENT_KEYS = ['Calories', 'Protein', 'Carbs', 'Saturated_Fat', 'Unsaturated_Fat', 'Fiber', 'Sugar', 'Sodium', 'Potassium', 'Iron']
+GOAL_KEYS = ['Calorie_Goal', 'Protein_Goal', 'Carbs_Goal', 'Saturated_Fat_Goal', 'Unsaturated_Fat_Goal', 'Fiber_Goal', 'Sugar_Goal', 'Sodium_Goal', 'Potassium_Goal', 'Iron_Goal']
+NUTRIENT_FIELDS = ['calories', 'protein', 'carbs', 'saturated_fat', 'unsaturated_fat', 'fiber', 'sugar', 'sodium', 'potassium', 'iron']
+
+@dataclass(slots=True)
+class NutrientVector:
+    """The ten tracked nutrients, used both for meal values and for daily goals."""
+    calories: float = 0.0
+    protein: float = 0.0
+    carbs: float = 0.0
+    saturated_fat: float = 0.0
+    unsaturated_fat: float = 0.0
+    fiber: float = 0.0
+    sugar: float = 0.0
+    sodium: float = 0.0
+    potassium: float = 0.0
+    iron: float = 0.0
+
+    @classmethod
+    def from_record(cls, record, keys=NUTRIENT_KEYS):
+        return cls(*(safe_float(record.get(k, 0)) for k in keys))
+
+    def values(self):
+        return [getattr(self, f) for f in NUTRIENT_FIELDS]
+
+    def to_dict(self, keys=NUTRIENT_KEYS):
+        return dict(zip(keys, self.values()))
+
+    def __add__(self, other):
+        return NutrientVector(*(a + b for a, b in zip(self.values(), other.values())))
+
+    def scaled(self, factor):
+        return NutrientVector(*(round(v * factor, 1) for v in self.values()))
+
+@dataclass(slots=True)
+class FoodLogEntry:
+    """One row of the Food_Logs sheet."""
+    log_id: str
+    timestamp: str
+    date_ref: str
+    user_id: str
+    meal_name: str
+    nutrients: NutrientVector
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(
+            log_id=str(record.get('Log_ID', '')),
+            timestamp=str(record.get('Timestamp', '')),
+            date_ref=str(record.get('Date_Ref', '')),
+            user_id=str(record.get('User_ID', '')),
+            meal_name=str(record.get('Meal_Name') or 'Unknown Meal'),
+            nutrients=NutrientVector.from_record(record),
+        )
+
+@dataclass(slots=True)
+class UserProfile:
+    """A Users sheet row without the credentials (Password/Approved are only read at login)."""
+    user_id: str
+    username: str
+    goals: NutrientVector
+    rank_tier: str = 'Bronze'
+    rank_multiplier: float = 1.0
+    rank_points: int = 0
+    weekly_wins: int = 0
+    age: int = 25
+    gender: str = 'Male'
+    weight: float = 70.0
+    height: float = 175.0
+    activity_level: str = '1.2'
+    primary_directive: str = 'Maintain'
+    measurement_system: str = 'metric'
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(
+            user_id=str(record.get('User_ID', '')),
+            username=str(record.get('Username', 'User')),
+            goals=NutrientVector.from_record(record, GOAL_KEYS),
+            rank_tier=str(record.get('Current_Rank_Tier') or 'Bronze'),
+            rank_multiplier=safe_float(record.get('Current_Rank_Multiplier'), 1.0),
+            rank_points=safe_int(record.get('Rank_Points_Counter')),
+            weekly_wins=safe_int(record.get('Total_Weekly_Wins')),
+            age=safe_int(record.get('Age'), 25),
+            gender=str(record.get('Gender') or 'Male'),
+            weight=safe_float(record.get('Weight'), 70.0),
+            height=safe_float(record.get('Height'), 175.0),
+            activity_level=str(record.get('Activity_Level') or '1.2'),
+            primary_directive=str(record.get('Primary_Directive') or 'Maintain'),
+            measurement_system=str(record.get('Measurement_System') or 'metric'),
+        )
+
+    def apply_goals(self, new_goals):
+        """Updates goals from a {'Calorie_Goal': ..., ...} dict (form or AI output)."""
+        for key, field in zip(GOAL_KEYS, NUTRIENT_FIELDS):
+            if key in new_goals:
+                setattr(self.goals, field, safe_float(new_goals[key]))
+
 # -----------------------------------------------------------------------------
 # 2. GOOGLE SHEETS CONNECTION
 # -----------------------------------------------------------------------------
@@ -69,6 +192,73 @@ def get_main_sheet(client):
     """Helper to get the specific worksheet by ID."""
     return client.open_by_key(SHEET_ID).sheet1
 
+def get_logs_sheet(client):
+    """Helper to get the Food_Logs worksheet."""
+    return client.open_by_key(SHEET_ID).worksheet("Food_Logs")
+
+# Column projections: each view only downloads the columns it renders.
+LOGIN_COLUMNS = ['User_ID', 'Username', 'Password', 'Approved']
+LEADERBOARD_COLUMNS = ['Username', 'Rank_Points_Counter', 'Current_Rank_Tier']
+LOG_COLUMNS = ['Log_ID', 'Timestamp', 'Date_Ref', 'User_ID', 'Meal_Name'] + NUTRIENT_KEYS
+
+def column_letter(idx):
+    """1-based column index to A1 letters (1 -> A, 27 -> AA)."""
+    letters = ""
+    while idx:
+        idx, rem = divmod(idx - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def sheet_headers(_sheet, title):
+    """Header row of a worksheet, cached so the name -> column mapping is resolved once."""
+    return _sheet.row_values(1)
+
+def read_columns(sheet, columns, retry=True):
+    """
+    Fetches only the named columns with a single batch_get and returns one dict per data row.
+    Values come back typed (numbers as numbers); '_row' holds the 1-based sheet row.
+    Each range includes the header cell, so a stale cached mapping (column inserted or moved)
+    is detected: the header cache is cleared and the read retried once.
+    """
+    headers = sheet_headers(sheet, sheet.title)
+    wanted = [c for c in columns if c in headers]
+    if not wanted:
+        return []
+    ranges = []
+    for c in wanted:
+        letter = column_letter(headers.index(c) + 1)
+        ranges.append(f"{letter}1:{letter}")
+
+    value_ranges = sheet.batch_get(
+        ranges,
+        major_dimension="COLUMNS",
+        value_render_option="UNFORMATTED_VALUE",
+        date_time_render_option="FORMATTED_STRING",
+    )
+    cols = [vr[0] if vr else [] for vr in value_ranges]
+    if any(not col or str(col[0]) != c for c, col in zip(wanted, cols)):
+        if not retry:
+            raise RuntimeError(f"Column layout of '{sheet.title}' does not match its header row")
+        sheet_headers.clear()
+        return read_columns(sheet, columns, retry=False)
+    cols = [col[1:] for col in cols]
+    n_rows = max((len(col) for col in cols), default=0)
+
+    records = []
+    for i in range(n_rows):
+        record = {c: (col[i] if i < len(col) else "") for c, col in zip(wanted, cols)}
+        record['_row'] = i + 2
+        records.append(record)
+    return records
+
+def read_row(sheet, row):
+    """One full sheet row as a header -> value dict."""
+    headers = sheet_headers(sheet, sheet.title)
+    values = sheet.row_values(row, value_render_option="UNFORMATTED_VALUE")
+    values += [""] * (len(headers) - len(values))
+    return dict(zip(headers, values))
+
 # Colors & Theme Constants
 THEME_BG = "#0f172a"
 THEME_CARD_BG = "rgba(30, 41, 59, 0.5)"
@@ -207,22 +397,211 @@ if 'user' not in st.session_state:
 if 'active_tab' not in st.session_state:
     st.session_state.active_tab = "Dashboard"
 
-def get_gemini_response(prompt, image=None, json_mode=False):
+# GEMINI RESILIENCE
+# One circuit breaker per server process, shared by every session. Once the
+# recent error rate is too high, calls fail fast instead of each spending up
+# to 3 x 30 s in retries.
+
+GEMINI_BUSY_MESSAGE = "SERVER BUSY: Google is overloaded right now. Please try again in a minute."
+
+class CircuitBreaker:
+    """Closed -> open when the recent error rate crosses a threshold; after a cooldown a single probe is let through (half-open)."""
+
+    def __init__(self, window=20, min_calls=5, error_rate=0.5, cooldown=30):
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self.state = "closed"
+        self._outcomes = deque(maxlen=window)
+        self._opened_at = 0.0
+        self._probing = False
+        self._probe_started = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == "open" and time.time() - self._opened_at >= self.cooldown:
+                self.state = "half_open"
+                self._probing = False
+            if self.state == "half_open":
+                # A probe that never reported back (e.g. its session went away) expires after a cooldown
+                if self._probing and time.time() - self._probe_started < self.cooldown:
+                    return False
+                self._probing = True
+                self._probe_started = time.time()
+                return True
+            return self.state == "closed"
+
+    def record(self, ok):
+        """ok=None means the call was abandoned without a verdict; it only releases a half-open probe."""
+        with self._lock:
+            if self.state == "half_open":
+                self._probing = False
+                if ok is None:
+                    return
+                if ok:
+                    self.state = "closed"
+                    self._outcomes.clear()
+                else:
+                    self.state = "open"
+                    self._opened_at = time.time()
+                return
+            if ok is None:
+                return
+            self._outcomes.append(ok)
+            failures = self._outcomes.count(False)
+            if len(self._outcomes) >= self.min_calls and failures / len(self._outcomes) >= self.error_rate:
+                self.state = "open"
+                self._opened_at = time.time()
+
+class LatencyTracker:
+    """Rolling window of successful call latencies, used to set the hedging deadline."""
+
+    def __init__(self, size=200):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def p95(self, min_samples=20):
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < min_samples:
+            return None
+        return samples[int(0.95 * (len(samples) - 1))]
+
+class HedgeBudget:
+    """Allows a hedge only while hedges stay under `ratio` of the calls made in the last `window` seconds."""
+
+    def __init__(self, ratio=0.1, window=60):
+        self.ratio = ratio
+        self.window = window
+        self._calls = deque()
+        self._hedges = deque()
+        self._lock = threading.Lock()
+
+    def _prune(self, now):
+        for stamps in (self._calls, self._hedges):
+            while stamps and now - stamps[0] > self.window:
+                stamps.popleft()
+
+    def record_call(self):
+        with self._lock:
+            now = time.time()
+            self._prune(now)
+            self._calls.append(now)
+
+    def try_hedge(self):
+        with self._lock:
+            now = time.time()
+            self._prune(now)
+            if len(self._hedges) + 1 > self.ratio * len(self._calls):
+                return False
+            self._hedges.append(now)
+            return True
+
+@st.cache_resource
+def get_gemini_breaker():
+    return CircuitBreaker()
+
+@st.cache_resource
+def get_gemini_latency():
+    return LatencyTracker()
+
+@st.cache_resource
+def get_hedge_budget():
+    return HedgeBudget()
+
+@st.cache_resource
+def get_hedge_pool():
+    """Runs hedge requests only; primaries never queue here."""
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="gemini-hedge")
+
+def post_gemini(url, payload, stream=False, allow_hedge=True):
+    """
+    POSTs to Gemini. With the GEMINI_HEDGE secret enabled (non-streaming only), a second identical
+    request goes out if the first hasn't answered by the recent p95 latency; the first success wins.
+    Hedges are skipped while the breaker isn't closed or when the caller saw a 503 (allow_hedge=False),
+    and capped by the HedgeBudget so an overloaded endpoint never sees doubled traffic.
+    """
+    def send(timeout=30):
+        return requests.post(url, headers={"Content-Type": "application/json"}, json=payload, timeout=timeout, stream=stream)
+
+    deadline = None
+    if allow_hedge and not stream and st.secrets.get("GEMINI_HEDGE", False) and get_gemini_breaker().state == "closed":
+        deadline = get_gemini_latency().p95()
+    if deadline is None:
+        return send()
+
+    budget = get_hedge_budget()
+    budget.record_call()
+    # The primary starts on its own thread right away, so queueing never eats into the deadline;
+    # requests.post can't be interrupted, and the caller has to be free to take whichever answer lands first
+    primary = Future()
+    def run_primary():
+        try:
+            primary.set_result(send())
+        except Exception as e:
+            primary.set_exception(e)
+    threading.Thread(target=run_primary, daemon=True, name="gemini-primary").start()
+
+    done, _ = wait([primary], timeout=deadline)
+    if done or not budget.try_hedge():
+        return primary.result()
+
+    gemini_stats()['hedges'] += 1
+    # Never outlives the primary's own timeout, so a losing hedge frees its worker as soon as the primary would
+    hedge = get_hedge_pool().submit(send, max(30 - deadline, 1))
+    try:
+        pending = {primary, hedge}
+        last_response, last_error = None, None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                try:
+                    response = f.result()
+                except Exception as e:
+                    last_error = e
+                    continue
+                if response.status_code == 200:
+                    return response
+                last_response = response
+        if last_response is not None:
+            return last_response
+        raise last_error
+    finally:
+        hedge.cancel() # drops it if it is still queued behind other hedges
+
+GEMINI_MODEL_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-flash-latest"
+
+def get_gemini_response(prompt, image=None, json_mode=False, on_partial=None, schema=None):
     """
     Direct API Connection with Auto-Retry for 503 (Server Overload) Errors.
+    `image` may be a single PIL image or a list of them (batch analysis).
+    If `on_partial` is given the reply is streamed and the callback receives the text so far.
+    `schema` (JSON mode only) constrains the reply to a responseSchema.
     """
     api_key = st.secrets.get("GEMINI_API_KEY")
     if not api_key: return "ERROR: No API Key found in secrets."
 
     # Use 'gemini-flash-latest' to get the most stable free model
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-flash-latest:generateContent?key={api_key}"
+    if on_partial:
+        url = f"{GEMINI_MODEL_URL}:streamGenerateContent?alt=sse&key={api_key}"
+    else:
+        url = f"{GEMINI_MODEL_URL}:generateContent?key={api_key}"
     
-    # 1. Prepare Image
+    # 1. Prepare Image(s)
     parts = [{"text": prompt}]
-    if image:
+    images = image if isinstance(image, list) else [image]
+    for img in images:
+        if not img:
+            continue
         try:
             buffered = io.BytesIO()
-            image.save(buffered, format="JPEG")
+            img.convert("RGB").save(buffered, format="JPEG")
             img_b64 = base64.b64encode(buffered.getvalue()).decode("utf-8")
             parts.append({"inline_data": {"mime_type": "image/jpeg", "data": img_b64}})
         except Exception as e:
@@ -232,147 +611,619 @@ def get_gemini_response(prompt, image=None, json_mode=False):
     payload = {"contents": [{"parts": parts}]}
     if json_mode:
         payload["generationConfig"] = {"response_mime_type": "application/json"}
+        if schema:
+            payload["generationConfig"]["response_schema"] = schema
 
-    # 3. Send Request with RETRY Logic (The New Part)
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            response = requests.post(
-                url, 
-                headers={"Content-Type": "application/json"}, 
-                json=payload, 
-                timeout=30
-            )
+    # 3. Fail fast while the endpoint is known to be struggling
+    breaker = get_gemini_breaker()
+    if not breaker.allow():
+        return GEMINI_BUSY_MESSAGE
+
+    # 4. Send Request with RETRY Logic. The outcome is settled in `finally`, so a rerun or stop
+    # (BaseException) that aborts a streamed call can't leave a half-open probe stuck.
+    outcome = None
+    try:
+        max_retries = 3
+        saw_503 = False
+        for attempt in range(max_retries):
+            started = time.time()
+            try:
+                response = post_gemini(url, payload, stream=bool(on_partial), allow_hedge=not saw_503)
             
-            # SUCCESS: Return the text immediately
-            if response.status_code == 200:
-                return response.json()['candidates'][0]['content']['parts'][0]['text']
+                # SUCCESS: Return the text immediately
+                if response.status_code == 200:
+                    usage = {}
+                    if on_partial:
+                        text = read_gemini_stream(response, on_partial, usage)
+                    else:
+                        body = response.json()
+                        usage = body.get('usageMetadata', {})
+                        text = body['candidates'][0]['content']['parts'][0]['text']
+                        get_gemini_latency().add(time.time() - started)
+                    record_gemini_usage(usage, time.time() - started)
+                    outcome = True
+                    return text
             
-            # BUSY SIGNAL (503): Wait and try again
-            if response.status_code == 503:
-                time.sleep(2)  # Wait 2 seconds
-                continue       # Loop back and try again
+                # BUSY SIGNAL (503): Wait and try again
+                if response.status_code == 503:
+                    saw_503 = True # Don't add hedged traffic to an endpoint that's shedding load
+                    time.sleep(2)  # Wait 2 seconds
+                    continue       # Loop back and try again
             
-            # OTHER ERRORS: Stop and report
-            return f"API ERROR ({response.status_code}): {response.text}"
+                # OTHER ERRORS: Stop and report (only quota/server errors count against the breaker)
+                outcome = response.status_code != 429 and response.status_code < 500
+                return f"API ERROR ({response.status_code}): {response.text}"
             
-        except Exception as e:
-            return f"CONNECTION ERROR: {str(e)}"
+            except Exception as e:
+                outcome = False
+                return f"CONNECTION ERROR: {str(e)}"
             
-    return "SERVER BUSY: Google is overloaded right now. Please try again in a minute."
+        outcome = False
+        return GEMINI_BUSY_MESSAGE
+    finally:
+        breaker.record(outcome)
+
+def read_gemini_stream(response, on_partial, usage):
+    """Collects a server-sent-events reply from streamGenerateContent, reporting progress per chunk."""
+    text = ""
+    for line in response.iter_lines(decode_unicode=True):
+        if not line or not line.startswith("data:"):
+            continue
+        chunk = json.loads(line[len("data:"):])
+        candidates = chunk.get('candidates') or [{}]
+        for part in candidates[0].get('content', {}).get('parts', []):
+            text += part.get('text', "")
+        usage.update(chunk.get('usageMetadata', {}))
+        on_partial(text)
+    return text
+
+# Matches "Key": "string" or "Key": number, but only once the value is complete
+# (a trailing number is not trusted until a delimiter follows it).
+PARTIAL_JSON_FIELD = re.compile(r'"(\w+)"\s*:\s*("(?:[^"\\]|\\.)*"|-?\d+(?:\.\d+)?(?=\s*[,}\n]))')
+
+def parse_partial_json(text):
+    """Extracts the fields that have fully arrived from a (possibly truncated) flat JSON object."""
+    fields = {}
+    for key, raw in PARTIAL_JSON_FIELD.findall(text):
+        try:
+            fields[key] = json.loads(raw)
+        except ValueError:
+            continue
+    return fields
+
+# STRUCTURED OUTPUT
+# Replies are constrained with a responseSchema. Key order puts Meal_Name and
+# Calories first, so a streamed reply shows them before the rest.
+
+def object_schema(string_keys, number_keys):
+    props = {k: {"type": "STRING"} for k in string_keys}
+    props.update({k: {"type": "NUMBER"} for k in number_keys})
+    keys = list(string_keys) + list(number_keys)
+    return {"type": "OBJECT", "properties": props, "required": keys, "propertyOrdering": keys}
+
+NUTRITION_SCHEMA = object_schema(['Meal_Name'], NUTRIENT_KEYS)
+NUTRIENT_UNITS_HINT = "Calories in kcal, Sodium, Potassium and Iron in mg, everything else in g"
+NUTRITION_BATCH_SCHEMA = {"type": "ARRAY", "items": NUTRITION_SCHEMA}
+TARGETS_SCHEMA = object_schema([], GOAL_KEYS)
+
+GEMINI_ERROR_PREFIXES = ("ERROR:", "IMAGE ERROR", "API ERROR", "CONNECTION ERROR", "SERVER BUSY")
+
+def is_gemini_error(text):
+    return text.startswith(GEMINI_ERROR_PREFIXES)
+
+def validate_structured(data, schema):
+    """Strict check of parsed JSON against one of the schemas above; returns only the schema's keys."""
+    if schema["type"] == "ARRAY":
+        if not isinstance(data, list) or not data:
+            raise ValueError("expected a non-empty JSON array")
+        return [validate_structured(item, schema["items"]) for item in data]
+
+    if not isinstance(data, dict):
+        raise ValueError("expected a JSON object")
+    clean = {}
+    for key, spec in schema["properties"].items():
+        if key not in data:
+            raise ValueError(f"missing key {key}")
+        val = data[key]
+        if spec["type"] == "NUMBER":
+            if isinstance(val, bool) or not isinstance(val, (int, float)) or val < 0:
+                raise ValueError(f"{key} must be a non-negative number")
+        elif not isinstance(val, str) or not val.strip():
+            raise ValueError(f"{key} must be a non-empty string")
+        clean[key] = val
+    return clean
+
+def gemini_stats():
+    """Per-session counters for Gemini usage, shown under Diagnostics."""
+    if 'gemini_stats' not in st.session_state:
+        st.session_state.gemini_stats = {
+            'calls': 0, 'prompt_tokens': 0, 'output_tokens': 0, 'latency_s': 0.0,
+            'parse_failures': 0, 'repairs': 0, 'hedges': 0,
+        }
+    return st.session_state.gemini_stats
+
+def record_gemini_usage(usage, latency):
+    stats = gemini_stats()
+    stats['calls'] += 1
+    stats['prompt_tokens'] += usage.get('promptTokenCount', 0)
+    stats['output_tokens'] += usage.get('candidatesTokenCount', 0)
+    stats['latency_s'] += latency
+
+def request_structured(prompt, schema, image=None, on_partial=None, expected_len=None):
+    """
+    Schema-constrained Gemini call with strict validation and a single automatic repair attempt.
+    Returns (data, None) on success or (None, error message) using the usual error strings.
+    """
+    response_text = get_gemini_response(prompt, image, json_mode=True, on_partial=on_partial, schema=schema)
+    if is_gemini_error(response_text):
+        return None, response_text
 
+    stats = gemini_stats()
+    for attempt in range(2):
+        try:
+            data = validate_structured(json.loads(clean_json_text(response_text)), schema)
+            if expected_len is not None and len(data) != expected_len:
+                raise ValueError(f"expected {expected_len} items, got {len(data)}")
+            return data, None
+        except ValueError as e: # json.JSONDecodeError is a ValueError
+            stats['parse_failures'] += 1
+            if attempt:
+                break
+            stats['repairs'] += 1
+            repair_prompt = f"{prompt}\nYour previous reply failed validation ({e}):\n{response_text}\nReturn the corrected JSON only."
+            # Same inputs again: a wrong item count needs a re-analysis of the photos, not just a syntax fix
+            response_text = get_gemini_response(repair_prompt, image, json_mode=True, schema=schema)
+            if is_gemini_error(response_text):
+                return None, response_text
+    return None, f"Failed to parse AI response. Raw: {response_text}"
+
+# SHARED CACHE
+# Sheets reads are cached in a backend that every server process can see, so
+# replicas share one copy (and one quota budget). Keys embed a per-namespace
+# version number; a write on any replica bumps the version, which invalidates
+# that namespace everywhere.
+
+SHARED_CACHE_TTL = 120 # seconds; also bounds staleness after manual sheet edits
+
+class CacheBackend(ABC):
+    """Minimal key/value interface for the shared cache. Values are strings."""
+
+    @abstractmethod
+    def get(self, key):
+        ...
+
+    @abstractmethod
+    def set(self, key, value, ttl):
+        ...
+
+    @abstractmethod
+    def incr(self, key):
+        ...
+
+class SQLiteCache(CacheBackend):
+    """Default backend: a SQLite file shared by all processes on the host."""
+
+    def __init__(self, path):
+        self.path = path
+        db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        try:
+            db.execute("PRAGMA journal_mode=WAL") # readers never wait on the writer
+            db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expires REAL)")
+        finally:
+            db.close()
+
+    def _execute(self, *statements):
+        """Runs write statements in one IMMEDIATE transaction; returns the last statement's rows."""
+        db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            rows = None
+            for sql, params in ((s[0], s[1:]) if isinstance(s, tuple) else (s, ()) for s in statements):
+                rows = db.execute(sql, params).fetchall()
+            db.execute("COMMIT")
+            return rows
+        finally:
+            db.close()
+
+    def get(self, key):
+        # Plain autocommit SELECT: takes no write lock, so reads run concurrently with each other and the writer
+        db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        try:
+            row = db.execute("SELECT value FROM cache WHERE key = ? AND (expires IS NULL OR expires > ?)", (key, time.time())).fetchone()
+        finally:
+            db.close()
+        return row[0] if row else None
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        self._execute(
+            ("DELETE FROM cache WHERE expires IS NOT NULL AND expires <= ?", now),
+            ("INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)", key, value, now + ttl),
+        )
 
-    # 2. Construct the Payload
-    payload = {
-        "contents": [{"parts": parts}]
-    }
-    
-    # 3. Handle JSON Mode
-    if json_mode:
-        payload["generationConfig"] = {"response_mime_type": "application/json"}
+    def incr(self, key):
+        rows = self._execute(
+            ("INSERT INTO cache (key, value, expires) VALUES (?, '1', NULL) "
+             "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1", key),
+            ("SELECT value FROM cache WHERE key = ?", key),
+        )
+        return int(rows[0][0])
+
+class RedisCache(CacheBackend):
+    """Speaks the Redis wire protocol (RESP) directly, so any Redis-compatible server works."""
+
+    def __init__(self, url):
+        parsed = urllib.parse.urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self._sock = None
+        self._reader = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        self._sock = socket.create_connection((self.host, self.port), timeout=2)
+        self._reader = self._sock.makefile("rb")
+        if self.password:
+            self._send("AUTH", self.password)
+        if self.db:
+            self._send("SELECT", self.db)
+
+    def _close(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+        self._sock = self._reader = None
+
+    def _send(self, *args):
+        out = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+            out.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        self._sock.sendall(b"".join(out))
+        return self._read_reply()
+
+    def _read_reply(self):
+        line = self._reader.readline()
+        if not line:
+            raise ConnectionError("Redis connection closed")
+        kind, body = line[:1], line[1:-2]
+        if kind == b"+":
+            return body.decode("utf-8")
+        if kind == b"-":
+            raise RuntimeError(body.decode("utf-8"))
+        if kind == b":":
+            return int(body)
+        if kind == b"$":
+            size = int(body)
+            return None if size == -1 else self._reader.read(size + 2)[:-2]
+        if kind == b"*":
+            size = int(body)
+            return None if size == -1 else [self._read_reply() for _ in range(size)]
+        raise RuntimeError(f"Unexpected Redis reply: {line!r}")
+
+    def execute(self, *args):
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    return self._send(*args)
+                except (OSError, ConnectionError):
+                    self._close()
+                    if attempt:
+                        raise
+
+    def get(self, key):
+        value = self.execute("GET", key)
+        return value.decode("utf-8") if value is not None else None
+
+    def set(self, key, value, ttl):
+        self.execute("SET", key, value, "EX", max(int(ttl), 1))
+
+    def incr(self, key):
+        return self.execute("INCR", key)
+
+@st.cache_resource
+def get_shared_cache():
+    """
+    Backend chosen by the CACHE_BACKEND secret: "sqlite" (default), "redis" (uses REDIS_URL) or "none".
+    """
+    kind = str(st.secrets.get("CACHE_BACKEND", "sqlite")).lower()
+    if kind == "none":
+        return None
+    if kind == "redis":
+        return RedisCache(st.secrets.get("REDIS_URL", "redis://localhost:6379/0"))
+    path = st.secrets.get("CACHE_PATH", os.path.join(tempfile.gettempdir(), "nutricomp_cache.sqlite3"))
+    return SQLiteCache(path)
 
-    # 4. Send Request
+def cached_read(namespace, key, loader, ttl=SHARED_CACHE_TTL):
+    """
+    Returns loader() through the shared cache. Loader exceptions propagate and are not cached;
+    an unavailable cache backend just falls through to the loader.
+    """
+    cache = get_shared_cache()
+    if cache is None:
+        return loader()
     try:
-        response = requests.post(
-            url, 
-            headers={"Content-Type": "application/json"}, 
-            json=payload,
-            timeout=10
-        )
-        
-        # Check for errors (404, 403, 500, etc)
-        if response.status_code != 200:
-            return f"API ERROR ({response.status_code}): {response.text}"
-            
-        return response.json()['candidates'][0]['content']['parts'][0]['text']
-        
-    except Exception as e:
-        return f"CONNECTION ERROR: {str(e)}"
+        version = cache.get(f"ver:{namespace}") or "0"
+        full_key = f"{namespace}:v{version}:{key}"
+        hit = cache.get(full_key)
+        if hit is not None:
+            return json.loads(hit)
+    except Exception:
+        return loader()
+
+    value = loader()
+    try:
+        cache.set(full_key, json.dumps(value), ttl)
+    except Exception:
+        pass
+    return value
+
+def invalidate_shared(namespace):
+    """Bumps a namespace version so every replica stops using its cached entries."""
+    cache = get_shared_cache()
+    if cache is None:
+        return
+    try:
+        cache.incr(f"ver:{namespace}")
+    except Exception:
+        pass
+
+MEAL_CACHE_TTL = 30 * 24 * 3600
+
+def meal_cache_key(user_id, description):
+    """Per user: "my usual lunch" means something different for everyone."""
+    normalized = " ".join(description.lower().split())
+    digest = hashlib.sha256(f"{user_id}\n{normalized}".encode("utf-8")).hexdigest()[:32]
+    return f"meal:{digest}"
+
+def remember_meal_analysis(user_id, description, data):
+    """Keeps a user's text-only analysis around so they can log the same meal while Gemini is unavailable."""
+    cache = get_shared_cache()
+    if cache is None or not description.strip():
+        return
+    try:
+        cache.set(meal_cache_key(user_id, description), json.dumps(data), MEAL_CACHE_TTL)
+    except Exception:
+        pass
+
+def recall_meal_analysis(user_id, description):
+    cache = get_shared_cache()
+    if cache is None or not description.strip():
+        return None
+    try:
+        hit = cache.get(meal_cache_key(user_id, description))
+    except Exception:
+        return None
+    return json.loads(hit) if hit is not None else None
+
+
+# IDEMPOTENT WRITES
+# Every append carries an idempotency key (Log_ID for meals, User_ID for accounts).
+# Before a retry the key is looked up in the sheet, so an append Google applied
+# whose response never arrived is not written a second time.
+
+SHEETS_WRITE_ATTEMPTS = 4
+SHEETS_RETRY_BACKOFF = 0.5 # seconds, doubled after every failed attempt
+
+def is_transient_error(e):
+    """Quota, server and network errors are worth retrying; anything else is a real failure."""
+    if isinstance(e, gspread.exceptions.APIError):
+        return e.response.status_code == 429 or e.response.status_code >= 500
+    return isinstance(e, (requests.exceptions.RequestException, OSError))
+
+def idempotent_append(sheet, rows, key_column, check_first=False):
+    """
+    Appends rows ({idempotency key: row values}) with retries on transient errors.
+    Before every retry, and before the first attempt when check_first is set, rows whose key
+    already appears in key_column are dropped.
+    """
+    pending = dict(rows)
+    for attempt in range(SHEETS_WRITE_ATTEMPTS):
+        try:
+            if attempt or check_first:
+                written = {str(r.get(key_column)) for r in read_columns(sheet, [key_column])}
+                pending = {k: row for k, row in pending.items() if k not in written}
+                if not pending:
+                    return
+            sheet.append_rows(list(pending.values()))
+            return
+        except Exception as e:
+            if attempt == SHEETS_WRITE_ATTEMPTS - 1 or not is_transient_error(e):
+                raise
+            time.sleep(SHEETS_RETRY_BACKOFF * 2 ** attempt)
+
+def pending_writes():
+    """Entries whose write failed this session, by Log_ID; re-submitting them keeps the same key."""
+    if 'pending_writes' not in st.session_state:
+        st.session_state.pending_writes = {}
+    return st.session_state.pending_writes
 
 
 # DATA HELPERS
 
-def fetch_all_users():
-    """Fetch all users for leaderboard."""
+def clean_json_text(response_text):
+    """Strips markdown code fences that the model sometimes wraps around JSON."""
+    json_str = response_text.strip()
+    if "```json" in json_str:
+        json_str = json_str.split("```json")[1].split("```")[0]
+    elif "```" in json_str:
+        json_str = json_str.split("```")[1].split("```")[0]
+    return json_str
+
+def build_log_entry(data, user_id):
+    """Turns a parsed AI nutrition dict into a FoodLogEntry stamped with a fresh Log_ID and the current time."""
+    now = datetime.now()
+    return FoodLogEntry(
+        log_id=f"l_{uuid.uuid4().hex}", # full width: Log_ID doubles as the idempotency key
+        timestamp=now.strftime("%Y-%m-%d %H:%M:%S"),
+        date_ref=now.strftime("%Y-%m-%d"),
+        user_id=str(user_id),
+        meal_name=str(data.get('Meal_Name') or 'Meal'),
+        nutrients=NutrientVector.from_record(data),
+    )
+
+def fetch_all_users(columns=LEADERBOARD_COLUMNS, use_cache=True):
+    """Fetch all users (only the requested columns), e.g. for the leaderboard or login."""
     client = get_db_connection()
     if not client:
         return [] # Return empty list if no DB
     try:
         sheet = get_main_sheet(client)
-        return sheet.get_all_records()
+        if not use_cache:
+            return read_columns(sheet, columns)
+        return cached_read("users", ",".join(columns), lambda: read_columns(sheet, columns))
     except:
         return []
 
+def fetch_user_record(row):
+    """Full Users row for a single account (used once the login has been verified)."""
+    client = get_db_connection()
+    if not client:
+        return None
+    try:
+        return read_row(get_main_sheet(client), row)
+    except:
+        return None
+
+def fetch_verified_user_record(login_record):
+    """
+    Full row for an account verified at login, or None if that row (looked up by number) no longer
+    holds the same User_ID/Username. A mismatch may only be a stale header mapping, so it is retried
+    once with the header cache cleared.
+    """
+    for attempt in range(2):
+        record = fetch_user_record(login_record['_row'])
+        if record and str(record.get('User_ID')) == str(login_record.get('User_ID')) \
+                and str(record.get('Username')) == str(login_record.get('Username')):
+            return record
+        sheet_headers.clear()
+    return None
+
 def register_user(username, password):
     """Register new user."""
     client = get_db_connection()
     if not client:
         return False, "Database not connected. Add GCP secrets."
         
+    # A re-click after a lost response reuses the same User_ID, so it can recognise its own row
+    pending = st.session_state.get('pending_registration')
+    if not pending or pending['username'] != username.lower():
+        pending = {'username': username.lower(), 'user_id': f"u_{uuid.uuid4().hex}"}
+        st.session_state.pending_registration = pending
+    new_id = pending['user_id']
+
     try:
         sheet = get_main_sheet(client)
-        records = sheet.get_all_records()
+        records = read_columns(sheet, ['User_ID', 'Username'])
         for r in records:
             if str(r.get('Username')).lower() == username.lower():
+                if str(r.get('User_ID')) == new_id:
+                    break # Our earlier attempt landed
                 return False, "Username taken."
-        
-        # Create new row
-        new_id = f"u_{str(uuid.uuid4())[:6]}"
-        # Headers: User_ID, Username, Password, Calorie_Goal, ... (Defaults)
-        row = [
-            new_id, username, password, 
-            2000, 150, 200, 20, 50, 25, 30, 2000, 3000, 15, # Default Macros
-            "Bronze", 1.0, 0, 0, 0, # Rank Data
-            25, "Male", 70, 175, 1.2, "Maintain", "metric", # Demographics
-            "No" # Approval Status
-        ]
-        sheet.append_row(row)
+        else:
+            # Create new row
+            # Headers: User_ID, Username, Password, Calorie_Goal, ... (Defaults)
+            row = [
+                new_id, username, password, 
+                2000, 150, 200, 20, 50, 25, 30, 2000, 3000, 15, # Default Macros
+                "Bronze", 1.0, 0, 0, 0, # Rank Data
+                25, "Male", 70, 175, 1.2, "Maintain", "metric", # Demographics
+                "No" # Approval Status
+            ]
+            idempotent_append(sheet, {new_id: row}, 'User_ID')
+            invalidate_shared("users")
+        st.session_state.pop('pending_registration', None)
         return True, "Registration successful! Account pending admin approval."
     except Exception as e:
         return False, f"Error: {str(e)}"
 
+def food_log_row(user_id, entry):
+    """Food_Logs column order for one entry: Log_ID, Timestamp, Date_Ref, User_ID, Meal_Name, then NUTRIENT_KEYS."""
+    return [entry.log_id, entry.timestamp, entry.date_ref, user_id, entry.meal_name] + entry.nutrients.values()
+
 def log_food_to_sheet(user_id, entry_data):
+    return log_foods_to_sheet(user_id, [entry_data])
+
+def log_foods_to_sheet(user_id, entries):
+    """
+    Writes several Food_Logs entries with a single (retried, Log_ID-deduplicated) append call.
+    Returns True on success; failed entries are kept in pending_writes() for a retry with the same Log_IDs.
+    """
+    pending = pending_writes()
     client = get_db_connection()
     if not client:
         if 'mock_logs' not in st.session_state: st.session_state.mock_logs = []
-        st.session_state.mock_logs.append(entry_data)
-        return
+        known = {l.log_id for l in st.session_state.mock_logs}
+        st.session_state.mock_logs.extend(e for e in entries if e.log_id not in known)
+        return True
 
     try:
         # Assuming Food_Logs is a separate sheet/tab. 
         # Safe approach: Open by key, then get worksheet by title "Food_Logs"
-        sheet = client.open_by_key(SHEET_ID).worksheet("Food_Logs")
-        
-        row = [
-            entry_data['Log_ID'], entry_data['Timestamp'], entry_data['Date_Ref'], 
-            user_id, entry_data['Meal_Name'], entry_data['Calories'], 
-            entry_data['Protein'], entry_data['Carbs'], entry_data['Saturated_Fat'],
-            entry_data['Unsaturated_Fat'], entry_data['Fiber'], entry_data['Sugar'],
-            entry_data['Sodium'], entry_data['Potassium'], entry_data['Iron']
-        ]
-        sheet.append_row(row)
+        sheet = get_logs_sheet(client)
+        retried = any(e.log_id in pending for e in entries)
+        idempotent_append(sheet, {e.log_id: food_log_row(user_id, e) for e in entries}, 'Log_ID', check_first=retried)
+        invalidate_shared(f"logs:{user_id}")
+        for e in entries:
+            pending.pop(e.log_id, None)
+        return True
     except Exception as e:
+        for entry in entries:
+            pending[entry.log_id] = entry
         st.error(f"Log Error: {e}")
+        return False
 
-def get_today_logs(user_id):
+def fetch_user_logs(user_id):
+    """Every Food_Logs entry for one user."""
     client = get_db_connection()
-    today_str = datetime.now().strftime("%Y-%m-%d")
-    
     if not client:
-        return [l for l in st.session_state.get('mock_logs', []) if l['Date_Ref'] == today_str]
-        
+        return [l for l in st.session_state.get('mock_logs', []) if l.user_id == str(user_id)]
+
     try:
-        sheet = client.open_by_key(SHEET_ID).worksheet("Food_Logs")
-        records = sheet.get_all_records()
-        return [r for r in records if str(r['User_ID']) == str(user_id) and r['Date_Ref'] == today_str]
+        sheet = get_logs_sheet(client)
+        # One cache namespace per user, so a meal logged by anyone else doesn't invalidate these entries
+        records = cached_read(f"logs:{user_id}", "all",
+                              lambda: [r for r in read_columns(sheet, LOG_COLUMNS) if str(r['User_ID']) == str(user_id)])
+        return [FoodLogEntry.from_record(r) for r in records]
     except:
         return []
 
+def discard_pending_writes(user_id):
+    """
+    Drops this session's unsaved entries, except any that reached the sheet after all (lost response),
+    which are kept as logged. Returns those entries, or None if the sheet couldn't be checked.
+    """
+    pending = pending_writes()
+    landed = []
+    client = get_db_connection()
+    if client:
+        try:
+            written = {str(r.get('Log_ID')) for r in read_columns(get_logs_sheet(client), ['Log_ID'])}
+        except Exception as e:
+            st.error(f"Log Error: {e}")
+            return None
+        landed = [e for e in pending.values() if e.log_id in written]
+    pending.clear()
+    if landed:
+        invalidate_shared(f"logs:{user_id}")
+        apply_logs_optimistically(user_id, landed)
+    return landed
+
+def get_today_logs(user_id):
+    today_str = datetime.now().strftime("%Y-%m-%d")
+    return [l for l in fetch_user_logs(user_id) if l.date_ref == today_str]
+
 def update_user_targets_db(user_id, new_data):
     """Updates user profile using the Submit Button in Identity Tab."""
     client = get_db_connection()
     if not client:
-        st.session_state.user.update(new_data)
+        st.session_state.user.apply_goals(new_data)
         return True
 
     try:
@@ -381,24 +1232,310 @@ def update_user_targets_db(user_id, new_data):
         cell = sheet.find(user_id)
         if cell:
             r = cell.row
+            # Writes resolve columns from a fresh header read; a stale mapping would write into the wrong column
             headers = sheet.row_values(1)
+            if headers != sheet_headers(sheet, sheet.title):
+                sheet_headers.clear()
             for key, val in new_data.items():
                 if key in headers:
                     col_idx = headers.index(key) + 1
                     sheet.update_cell(r, col_idx, val)
+            invalidate_shared("users")
             
-            st.session_state.user.update(new_data)
+            st.session_state.user.apply_goals(new_data)
             return True
     except Exception as e:
         st.error(f"Sync Error: {e}")
         return False
 
+# BACKGROUND PREFETCH
+
+@st.cache_resource
+def get_prefetch_pool():
+    """Small process-wide worker pool for warming Sheets reads off the script thread."""
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="prefetch")
+
+def submit_background(fn, *args):
+    """Runs fn(*args) on the prefetch pool with this session's script context attached."""
+    ctx = get_script_run_ctx()
+    def run():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return fn(*args)
+    return get_prefetch_pool().submit(run)
+
+def start_prefetch(user_id):
+    """
+    Right after authentication, warms today's logs and the leaderboard in the background.
+    The profile itself is read inline by the login, so it never queues behind other sessions' prefetches.
+    Futures are parked in st.session_state.prefetch, with their start time, until the first view that needs them.
+    """
+    if "gcp_service_account" not in st.secrets:
+        return # Mock mode reads session state directly; nothing to warm
+
+    now = time.time()
+    st.session_state.prefetch = {
+        ('today_logs', str(user_id)): (submit_background(get_today_logs, user_id), now),
+        'leaderboard': (submit_background(fetch_all_users), now),
+    }
+
+def prefetched(key, loader, *args):
+    """Result of the background prefetch for `key` (consumed once, if still fresh), else a synchronous load."""
+    future, submitted_at = st.session_state.get('prefetch', {}).pop(key, (None, 0.0))
+    if future is not None and time.time() - submitted_at <= SHARED_CACHE_TTL:
+        try:
+            return future.result(timeout=30)
+        except Exception:
+            pass
+    return loader(*args)
+
+# SESSION LOG CACHE
+# Today's logs are kept in session state. Writes are applied to it optimistically,
+# then a background re-read reconciles it with the sheet, so no rerun waits on a full refetch.
+
+LOG_CACHE_TTL = 300 # seconds before a background refresh is started
+
+def session_today_logs(user_id):
+    """Today's logs for this session, served from the session cache whenever possible."""
+    key = (str(user_id), datetime.now().strftime("%Y-%m-%d"))
+    cache = st.session_state.get('today_logs')
+    if not cache or cache['key'] != key:
+        logs = prefetched(('today_logs', str(user_id)), get_today_logs, user_id)
+        # 'pending': Log_IDs applied optimistically that a sheet read hasn't returned yet
+        cache = {'key': key, 'logs': logs, 'loaded_at': time.time(), 'refresh': None, 'pending': set()}
+        st.session_state.today_logs = cache
+
+    refresh = cache['refresh']
+    if refresh is not None and refresh.done():
+        cache['refresh'] = None
+        try:
+            fresh = refresh.result()
+            known = {l.log_id for l in fresh}
+            # The sheet is the source of truth: rows deleted or re-dated there disappear here too.
+            # Only our own optimistic writes it hasn't returned yet are carried over.
+            cache['pending'] -= known
+            cache['logs'] = fresh + [l for l in cache['logs'] if l.log_id in cache['pending']]
+            cache['loaded_at'] = time.time()
+        except Exception:
+            pass
+    elif refresh is None and time.time() - cache['loaded_at'] > LOG_CACHE_TTL:
+        reconcile_today_logs(user_id)
+    return cache['logs']
+
+def reconcile_today_logs(user_id):
+    """Starts a background re-read of today's logs; the result is merged on the next render."""
+    cache = st.session_state.get('today_logs')
+    if cache and "gcp_service_account" in st.secrets:
+        cache['refresh'] = submit_background(get_today_logs, user_id)
+
+def apply_logs_optimistically(user_id, entries):
+    """Adds freshly written entries to the session view and schedules reconciliation."""
+    session_today_logs(user_id)
+    cache = st.session_state.today_logs
+    today_str = cache['key'][1]
+    known = {l.log_id for l in cache['logs']}
+    added = [e for e in entries if e.date_ref == today_str and e.log_id not in known]
+    cache['logs'] = cache['logs'] + added
+    cache['pending'].update(e.log_id for e in added)
+
+    index = st.session_state.get('meal_index')
+    if index and index['user_id'] == str(user_id):
+        for e in entries:
+            index['index'].add(e)
+    reconcile_today_logs(user_id)
+
+# MEAL INDEX
+# Per-user index of previously logged meals, so a repeat meal can be re-logged
+# without a new description or a Gemini call.
+
+MEAL_RECENCY_HALF_LIFE = 14 # days; an occurrence this old counts half as much when ranking
+
+PORTION_SUFFIX = re.compile(r"^(.*?)\s*\(×(\d+(?:\.\d+)?)\)$")
+
+def normalize_meal_name(name):
+    return " ".join(str(name).lower().split())
+
+def portion_name(name, portion):
+    """Meal_Name written for a scaled re-log, e.g. "Oatmeal (×2)", so the sheet shows it's a multiple."""
+    return name if portion == 1 else f"{name} (×{portion:g})"
+
+def split_portion(name):
+    """Inverse of portion_name: ("Oatmeal (×2)") -> ("Oatmeal", 2.0)."""
+    match = PORTION_SUFFIX.match(str(name).strip())
+    if match and float(match.group(2)) > 0:
+        return match.group(1), float(match.group(2))
+    return str(name), 1.0
+
+@dataclass(slots=True)
+class IndexedMeal:
+    """A distinct past meal: its latest nutrient vector, how often it was logged and how recently."""
+    name: str
+    nutrients: NutrientVector
+    count: int = 0
+    last_logged: str = ""
+    score: float = 0.0
+
+class MealIndex:
+    """Prefix + fuzzy search over a user's past meals, ranked by frequency weighted by recency."""
+
+    def __init__(self, entries=()):
+        self.meals = {}
+        for entry in sorted(entries, key=lambda e: e.timestamp):
+            self.add(entry)
+
+    def add(self, entry):
+        # Scaled re-logs count towards their base meal, with the portion divided back out,
+        # so the indexed vector is always one portion and scaling never compounds
+        name, portion = split_portion(entry.meal_name)
+        key = normalize_meal_name(name)
+        if not key:
+            return
+        nutrients = entry.nutrients if portion == 1 else entry.nutrients.scaled(1 / portion)
+        meal = self.meals.get(key)
+        if meal is None:
+            meal = self.meals[key] = IndexedMeal(name, nutrients)
+        if entry.timestamp >= meal.last_logged:
+            meal.name, meal.nutrients, meal.last_logged = name, nutrients, entry.timestamp
+        meal.count += 1
+        meal.score += 0.5 ** (meal_age_days(entry) / MEAL_RECENCY_HALF_LIFE)
+
+    def search(self, query="", limit=5):
+        """Best matches for query: prefix matches first, then fuzzy ones; ties broken by rank score."""
+        query = normalize_meal_name(query)
+        ranked = []
+        for key, meal in self.meals.items():
+            similarity = 0.0
+            if not query or key.startswith(query) or any(word.startswith(query) for word in key.split()):
+                tier = 0
+            elif query in key:
+                tier = 1
+            else:
+                similarity = max(difflib.SequenceMatcher(None, query, part).ratio() for part in [key] + key.split())
+                if similarity < 0.6:
+                    continue
+                tier = 2
+            ranked.append((tier, -similarity, -meal.score, meal.name, meal))
+        ranked.sort(key=lambda r: r[:4])
+        return [r[4] for r in ranked[:limit]]
+
+def meal_age_days(entry):
+    try:
+        logged = datetime.strptime(entry.timestamp, "%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        try:
+            logged = datetime.strptime(entry.date_ref, "%Y-%m-%d")
+        except ValueError:
+            return 365.0
+    return max((datetime.now() - logged).total_seconds() / 86400, 0.0)
+
+def session_meal_index(user_id):
+    """The user's MealIndex, built once per session from Food_Logs and kept current on every write."""
+    cached = st.session_state.get('meal_index')
+    if not cached or cached['user_id'] != str(user_id):
+        cached = {'user_id': str(user_id), 'index': MealIndex(fetch_user_logs(user_id))}
+        st.session_state.meal_index = cached
+    return cached['index']
+
+def relog_meal(user_id, meal, portion=1.0):
+    """Logs a past meal again (scaled by portion) through the normal write path. Returns the entry, or None."""
+    data = meal.nutrients.scaled(portion).to_dict()
+    data['Meal_Name'] = portion_name(meal.name, portion)
+    entry = build_log_entry(data, user_id)
+    if not log_food_to_sheet(entry.user_id, entry):
+        return None
+    apply_logs_optimistically(entry.user_id, [entry])
+    return entry
+
+# TARGET CALCULATOR
+
+ACTIVITY_MULTIPLIERS = {
+    'sedentary': 1.2, 'light': 1.375, 'moderate': 1.55, 'active': 1.725, 'very active': 1.9, 'athlete': 1.9
+}
+
+def activity_multiplier(level):
+    """Activity_Level is stored as a TDEE multiplier (1.2 by default) but older rows may hold a label."""
+    factor = safe_float(level, None)
+    if factor is None:
+        factor = ACTIVITY_MULTIPLIERS.get(str(level).strip().lower(), 1.2)
+    return min(max(factor, 1.2), 2.4)
+
+def goal_profile(directive):
+    """(calorie adjustment in kcal, protein g per kg bodyweight) for the user's Primary_Directive."""
+    d = str(directive or "").lower()
+    # Gain terms win, so "Lean Bulk" / "Build lean muscle" aren't treated as a cut
+    if any(w in d for w in ("gain", "bulk", "muscle", "build")):
+        return 300, 1.8
+    if any(w in d for w in ("lose", "cut", "fat loss", "lean")):
+        return -500, 2.0
+    return 0, 1.6
+
+def body_metrics_metric(user):
+    """(weight kg, height cm) regardless of the user's Measurement_System."""
+    w_kg = user.weight or 70
+    h_cm = user.height or 170
+    if user.measurement_system == 'imperial':
+        w_kg = w_kg * 0.453
+        h_cm = h_cm * 2.54
+    return w_kg, h_cm
+
+def calculate_targets(user):
+    """
+    Deterministic daily targets: Mifflin-St Jeor BMR x activity multiplier, adjusted for the goal,
+    split into macros, with micronutrients from standard adult reference intakes.
+    """
+    age = user.age or 25
+    w_kg, h_cm = body_metrics_metric(user)
+    female = user.gender.lower().startswith('f')
+
+    bmr = 10 * w_kg + 6.25 * h_cm - 5 * age + (-161 if female else 5)
+    adjustment, protein_per_kg = goal_profile(user.primary_directive)
+    calories = max(bmr * activity_multiplier(user.activity_level) + adjustment, 1200 if female else 1500)
+
+    protein = w_kg * protein_per_kg
+    fat_kcal = calories * 0.30
+    sat_fat = calories * 0.10 / 9            # < 10% of energy
+    unsat_fat = fat_kcal / 9 - sat_fat
+    carbs = max(calories - protein * 4 - fat_kcal, 0) / 4
+
+    return {
+        'Calorie_Goal': round(calories),
+        'Protein_Goal': round(protein),
+        'Carbs_Goal': round(carbs),
+        'Saturated_Fat_Goal': round(sat_fat),
+        'Unsaturated_Fat_Goal': round(unsat_fat),
+        'Fiber_Goal': round(calories / 1000 * 14),    # 14 g per 1000 kcal
+        'Sugar_Goal': round(calories * 0.10 / 4),     # added sugar < 10% of energy
+        'Sodium_Goal': 2300,
+        'Potassium_Goal': 2600 if female else 3400,
+        'Iron_Goal': 18 if female and 19 <= age <= 50 else 8,
+    }
+
 # -----------------------------------------------------------------------------
 # 5. UI COMPONENTS
 # -----------------------------------------------------------------------------
 
+@st.cache_data(max_entries=1024, show_spinner=False)
+def avatar_data_uri(seed):
+    """
+    Deterministic identicon for a username: a mirrored 5x5 grid coloured from the seed's hash.
+    Returned as an inline data URI, so avatars never hit an external service.
+    """
+    digest = hashlib.sha256(str(seed).encode("utf-8")).digest()
+    hue = digest[0] * 360 // 256
+    fg = f"hsl({hue}, 70%, 60%)"
+    bg = f"hsl({hue}, 35%, 16%)"
+
+    cells = ""
+    for row in range(5):
+        for col in range(3):
+            if digest[1 + row * 3 + col] & 1:
+                for x in sorted({col, 4 - col}):
+                    cells += f'<rect x="{x + 1}" y="{row + 1}" width="1" height="1"/>'
+
+    svg = f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 7 7" shape-rendering="crispEdges"><rect width="7" height="7" fill="{bg}"/><g fill="{fg}">{cells}</g></svg>'
+    return "data:image/svg+xml;base64," + base64.b64encode(svg.encode("utf-8")).decode("ascii")
+
 def render_rank_card(user):
-    pts = safe_int(user.get('Rank_Points_Counter', 0))
+    pts = user.rank_points
 
     if pts > 450:
         tier, next_tier, min_p, max_p, color, icon = 'Platinum', 'Max Rank', 450, 1000, 'linear-gradient(to right, #22d3ee, #2563eb)', '💠'
@@ -416,7 +1553,7 @@ def render_rank_card(user):
         <div style="position: absolute; top: -50px; right: -50px; width: 200px; height: 200px; background: {color}; opacity: 0.15; filter: blur(60px); border-radius: 50%;"></div>
         <div style="display: flex; align-items: center; gap: 1.5rem; position: relative; z-index: 1;">
             <div style="position: relative;">
-                <img src="https://api.dicebear.com/7.x/avataaars/svg?seed={user.get('Username', 'User')}" style="width: 80px; height: 80px; border-radius: 20px; border: 2px solid #334155; box-shadow: 0 10px 15px -3px rgba(0, 0, 0, 0.5); object-fit: cover;">
+                <img src="{avatar_data_uri(user.username)}" style="width: 80px; height: 80px; border-radius: 20px; border: 2px solid #334155; box-shadow: 0 10px 15px -3px rgba(0, 0, 0, 0.5); object-fit: cover;">
                 <div style="position: absolute; bottom: -5px; right: -5px; background: #0f172a; padding: 2px; border-radius: 8px; border: 1px solid #1e293b; font-size: 1.2rem;">
                     {icon}
                 </div>
@@ -424,8 +1561,8 @@ def render_rank_card(user):
             <div style="flex: 1;">
                 <div style="display: flex; justify-content: space-between; align-items: end; margin-bottom: 0.5rem;">
                     <div>
-                        <h2 style="margin: 0; font-size: 1.5rem; line-height: 1;">{user.get('Username', 'User')}</h2>
-                        <span style="font-size: 0.75rem; font-weight: 800; text-transform: uppercase; color: #94a3b8; letter-spacing: 0.1em;">{tier} Tier • {user.get('Current_Rank_Multiplier', 1.0)}x Boost</span>
+                        <h2 style="margin: 0; font-size: 1.5rem; line-height: 1;">{user.username}</h2>
+                        <span style="font-size: 0.75rem; font-weight: 800; text-transform: uppercase; color: #94a3b8; letter-spacing: 0.1em;">{tier} Tier • {user.rank_multiplier:g}x Boost</span>
                     </div>
                     <div style="text-align: right;">
                         <span style="font-size: 0.75rem; font-weight: 800; text-transform: uppercase; color: #64748b;">Next: {next_tier}</span>
@@ -452,8 +1589,7 @@ def render_dashboard():
     user = st.session_state.user
     
     # Profile Check
-    goal_check = safe_float(user.get('Calorie_Goal', 0))
-    if goal_check == 0:
+    if user.goals.calories == 0:
         st.warning("⚠️ Profile Incomplete. Your nutrition targets are set to default.")
         if st.button("Set Nutrition Targets Now"):
             st.session_state.active_tab = "Identity"
@@ -462,17 +1598,17 @@ def render_dashboard():
     render_rank_card(user)
     st.write("") 
 
-    logs = get_today_logs(user['User_ID'])
+    logs = session_today_logs(user.user_id)
     
     # --- CALCULATE TOTALS ---
-    totals = {k: sum(safe_float(l.get(k, 0)) for l in logs) for k in ['Calories', 'Protein', 'Carbs', 'Saturated_Fat', 'Unsaturated_Fat', 'Fiber', 'Sugar', 'Sodium', 'Potassium', 'Iron']}
+    totals = sum((l.nutrients for l in logs), NutrientVector())
     
     col1, col2 = st.columns([1, 2])
     
     # --- ENERGY CARD ---
     with col1:
-        goal = safe_float(user.get('Calorie_Goal', 2000)) or 2000
-        pct = min((totals['Calories']/goal)*100, 100)
+        goal = user.goals.calories or 2000
+        pct = min((totals.calories/goal)*100, 100)
         
         st.markdown(f"""
 <div class="glass-card" style="height: 100%; display: flex; flex-direction: column; align-items: center; justify-content: center; text-align: center;">
@@ -481,7 +1617,7 @@ def render_dashboard():
         <svg viewBox="0 0 36 36" style="position: absolute; width: 100%; height: 100%; transform: rotate(-90deg);">
             <path stroke-dasharray="{pct}, 100" d="M18 2.0845 a 15.9155 15.9155 0 0 1 0 31.831 a 15.9155 15.9155 0 0 1 0 -31.831" stroke="{ACCENT_EMERALD}" stroke-width="3" fill="none" />
         </svg>
-        <span style="font-size: 2rem; font-weight: 900; color: white;">{int(totals['Calories'])}</span>
+        <span style="font-size: 2rem; font-weight: 900; color: white;">{int(totals.calories)}</span>
         <span style="font-size: 0.75rem; color: #64748b; font-weight: 700;">/ {int(goal)} kcal</span>
     </div>
 </div>
@@ -496,20 +1632,19 @@ def render_dashboard():
         defaults = {'Protein': 150, 'Carbs': 200, 'Fiber': 30, 'Saturated_Fat': 20, 'Unsaturated_Fat': 50, 'Sugar': 30, 'Sodium': 2300, 'Potassium': 3500, 'Iron': 18}
         
         metrics = [
-            ("Protein", totals['Protein'], user.get('Protein_Goal',0), 'g'),
-            ("Carbs", totals['Carbs'], user.get('Carbs_Goal',0), 'g'),
-            ("Fiber", totals['Fiber'], user.get('Fiber_Goal',0), 'g'),
-            ("Sat. Fat", totals['Saturated_Fat'], user.get('Saturated_Fat_Goal',0), 'g'),
-            ("Unsat. Fat", totals['Unsaturated_Fat'], user.get('Unsaturated_Fat_Goal',0), 'g'),
-            ("Sugar", totals['Sugar'], user.get('Sugar_Goal',0), 'g'),
-            ("Sodium", totals['Sodium'], user.get('Sodium_Goal',0), 'mg'),
-            ("Potassium", totals['Potassium'], user.get('Potassium_Goal',0), 'mg'),
-            ("Iron", totals['Iron'], user.get('Iron_Goal',0), 'mg'),
+            ("Protein", totals.protein, user.goals.protein, 'g'),
+            ("Carbs", totals.carbs, user.goals.carbs, 'g'),
+            ("Fiber", totals.fiber, user.goals.fiber, 'g'),
+            ("Sat. Fat", totals.saturated_fat, user.goals.saturated_fat, 'g'),
+            ("Unsat. Fat", totals.unsaturated_fat, user.goals.unsaturated_fat, 'g'),
+            ("Sugar", totals.sugar, user.goals.sugar, 'g'),
+            ("Sodium", totals.sodium, user.goals.sodium, 'mg'),
+            ("Potassium", totals.potassium, user.goals.potassium, 'mg'),
+            ("Iron", totals.iron, user.goals.iron, 'mg'),
         ]
         
-        for i, (label, val, goal, unit) in enumerate(metrics):
+        for i, (label, val, goal_f, unit) in enumerate(metrics):
             with m_cols[i % 3]:
-                goal_f = safe_float(goal)
                 if goal_f == 0: 
                     key = label.replace(". ", "_")
                     goal_f = defaults.get(key, 100)
@@ -548,17 +1683,11 @@ def render_dashboard():
         html_list += """<div style="padding: 1rem; text-align: center; color: #64748b; font-style: italic;">No logs yet. Go eat something! 🍎</div>"""
     else:
         for log in logs:
-            name = log.get('Meal_Name', 'Unknown Meal')
-            kcal = int(safe_float(log.get('Calories', 0)))
-            prot = float(safe_float(log.get('Protein', 0)))
-            carbs = float(safe_float(log.get('Carbs', 0)))
-            sat_fat = float(safe_float(log.get('Saturated_Fat', 0)))
-            unsat_fat = float(safe_float(log.get('Unsaturated_Fat', 0)))
-            fiber = float(safe_float(log.get('Fiber', 0)))
-            sugar = float(safe_float(log.get('Sugar', 0)))
-            sodium = float(safe_float(log.get('Sodium', 0)))
-            potassium = float(safe_float(log.get('Potassium', 0)))
-            iron = float(safe_float(log.get('Iron', 0)))
+            n = log.nutrients
+            name = log.meal_name
+            kcal = int(n.calories)
+            prot, carbs, sat_fat, unsat_fat = n.protein, n.carbs, n.saturated_fat, n.unsaturated_fat
+            fiber, sugar, sodium, potassium, iron = n.fiber, n.sugar, n.sodium, n.potassium, n.iron
 
             html_list += f"""
 <details style="background: rgba(15, 23, 42, 0.4); border: 1px solid rgba(51, 65, 85, 0.3); border-radius: 0.75rem; overflow: hidden; transition: all 0.2s;">
@@ -592,6 +1721,28 @@ def render_dashboard():
     st.markdown(html_list, unsafe_allow_html=True)
 
 
+def render_nutrition_preview(placeholder, fields):
+    """Live card for a streaming analysis: headline first, remaining nutrients fill in as they arrive."""
+    name = fields.get('Meal_Name', 'Analyzing…')
+    kcal = fields.get('Calories')
+    kcal_txt = f"{int(safe_float(kcal))} kcal" if kcal is not None else "… kcal"
+    units = {'Sodium': 'mg', 'Potassium': 'mg', 'Iron': 'mg'}
+
+    cells = ""
+    for k in NUTRIENT_KEYS[1:]:
+        val = f"{safe_float(fields[k]):g}{units.get(k, 'g')}" if k in fields else "…"
+        cells += f'<div><span style="color: #64748b;">{k.replace("_", " ")}:</span> <span style="color: white; font-weight: bold;">{val}</span></div>'
+
+    placeholder.markdown(f"""
+<div class="glass-card">
+    <div style="display: flex; justify-content: space-between; align-items: center; margin-bottom: 0.75rem;">
+        <h3 style="margin: 0; font-size: 1.25rem;">{name}</h3>
+        <span style="font-family: monospace; font-weight: 700; color: {ACCENT_EMERALD};">🔥 {kcal_txt}</span>
+    </div>
+    <div style="display: grid; grid-template-columns: repeat(3, 1fr); gap: 0.75rem; font-size: 0.8rem;">{cells}</div>
+</div>
+""", unsafe_allow_html=True)
+
 def render_food_logger():
     # 1. CSS to Style the Container to look like a "Glass Card"
     st.markdown("""
@@ -619,6 +1770,15 @@ def render_food_logger():
     </style>
     """, unsafe_allow_html=True)
 
+    pending_slot = st.container() # Filled last, so a write that fails during this run shows up right away
+
+    if st.toggle("Batch Mode", help="Log several meals with a single AI analysis."):
+        render_batch_logger()
+        render_pending_writes(pending_slot)
+        return
+
+    render_quick_relog()
+
     # 2. The "Box" itself
     with st.container(border=True):
         st.markdown('<h2 style="margin-top:0; font-size: 2rem;">Add Food 🍎</h2>', unsafe_allow_html=True)
@@ -641,10 +1801,10 @@ def render_food_logger():
         st.write("") # Spacer
         
         # 4. Action Button
-        submit = st.button("Log & Analyze Meal", use_container_width=True, type="primary")
+        submit = st.button("Log & Analyze Meal", use_container_width=True, type="primary", disabled=bool(pending_writes()))
 
     # 5. Logic Handling (Outside the layout code for cleanliness)
-    if submit:
+    if submit and not pending_writes(): # also covers a button rendered before a save failed this run
         if not prompt and not uploaded_file:
             st.error("Please provide a description or an image.")
         else:
@@ -660,60 +1820,173 @@ def render_food_logger():
                 # Build the AI Prompt
                 full_prompt = f"""
                 Analyze this meal: '{prompt}'. 
-                Provide nutritional data for the ENTIRE meal combined.
-                Return ONLY a valid JSON object with these keys: 
-                Meal_Name, Calories, Protein, Carbs, Saturated_Fat, Unsaturated_Fat, Fiber, Sugar, Sodium, Potassium, Iron.
-                All number values should be integers or floats (no units).
+                Provide nutritional data for the ENTIRE meal combined ({NUTRIENT_UNITS_HINT}).
                 Meal_Name should be a short, fun summary (e.g. "Avocado Toast").
                 """
                 
-                # Call AI
-                response_text = get_gemini_response(full_prompt, image_data, json_mode=True)
+                # Call AI (streamed, so the headline shows up before the full reply lands)
+                preview = st.empty()
+                shown = {}
+                def on_partial(text):
+                    fields = parse_partial_json(text)
+                    if len(fields) != len(shown):
+                        shown.clear()
+                        shown.update(fields)
+                        render_nutrition_preview(preview, fields)
+
+                data, error = request_structured(full_prompt, NUTRITION_SCHEMA, image_data, on_partial=on_partial)
+                if not error and image_data is None:
+                    remember_meal_analysis(st.session_state.user.user_id, prompt, data)
+                elif error and error.startswith("SERVER BUSY") and image_data is None:
+                    cached = recall_meal_analysis(st.session_state.user.user_id, prompt)
+                    if cached is not None:
+                        data, error = cached, None
+                        st.info("Gemini is unavailable right now, so this uses an earlier analysis of the same meal.")
                 
-                # Parse & Save
-                if "CONNECTION ERROR" in response_text or "API ERROR" in response_text:
-                    st.error(response_text)
+                # Save
+                if error:
+                    st.error(error)
                 else:
-                    try:
-                        # Clean JSON
-                        json_str = response_text.strip()
-                        if "```json" in json_str:
-                            json_str = json_str.split("```json")[1].split("```")[0]
-                        elif "```" in json_str:
-                            json_str = json_str.split("```")[1].split("```")[0]
-                            
-                        data = json.loads(json_str)
-                        
-                        # Add Timestamps
-                        data['User_ID'] = st.session_state.user['User_ID']
-                        data['Date'] = date.today().strftime("%Y-%m-%d")
-                        data['Time'] = datetime.now().strftime("%H:%M:%S")
-                        
-                        # Save to Sheet
-                        log_food_to_sheet(data)
-                        
-                        st.success(f"Successfully logged: **{data.get('Meal_Name', 'Meal')}** ({data.get('Calories', 0)} kcal)")
-                        st.balloons()
-                        time.sleep(1.5)
+                    render_nutrition_preview(preview, data)
+                    
+                    # Add IDs & Timestamps
+                    entry = build_log_entry(data, st.session_state.user.user_id)
+                    
+                    # Save to Sheet, then show it on the dashboard without refetching
+                    if log_food_to_sheet(entry.user_id, entry):
+                        apply_logs_optimistically(entry.user_id, [entry])
+                        st.toast(f"Logged: **{entry.meal_name}** ({int(entry.nutrients.calories)} kcal)", icon="🎉")
                         st.session_state.active_tab = "Dashboard"
                         st.rerun()
-                        
-                    except Exception as e:
-                        st.error(f"Failed to parse AI response. Raw: {response_text}")
+
+    render_pending_writes(pending_slot)
+
+def render_pending_writes(slot):
+    """Offers to re-submit meals whose save failed, under their original Log_IDs (no new AI call)."""
+    pending = pending_writes()
+    if not pending:
+        return
+    entries = list(pending.values())
+    names = ", ".join(e.meal_name for e in entries)
+    user_id = st.session_state.user.user_id
+    # New submits stay disabled meanwhile: a fresh Log_ID for the same meal would duplicate it on a later retry
+    slot.warning(f"Not saved yet: **{names}**. Retry or discard before logging another meal.")
+    col1, col2 = slot.columns(2)
+    if col1.button("Retry Save", key="retry_pending", use_container_width=True):
+        if log_foods_to_sheet(user_id, entries):
+            apply_logs_optimistically(user_id, entries)
+            st.toast(f"Saved {len(entries)} meal{'s' if len(entries) > 1 else ''}", icon="🎉")
+            st.session_state.active_tab = "Dashboard"
+            st.rerun()
+    if col2.button("Discard", key="discard_pending", use_container_width=True):
+        landed = discard_pending_writes(user_id)
+        if landed is not None:
+            if landed:
+                st.toast(f"{', '.join(e.meal_name for e in landed)} had been saved after all", icon="ℹ️")
+            st.rerun()
+
+def render_quick_relog():
+    """One-tap re-logging of past meals from the user's meal index (no AI call)."""
+    user_id = st.session_state.user.user_id
+    index = session_meal_index(user_id)
+    if not index.meals:
+        return
+
+    with st.expander("⚡ Quick Re-log", expanded=True):
+        col1, col2 = st.columns([2, 1])
+        with col1:
+            query = st.text_input("Search past meals", placeholder="Start typing, e.g. oat…", key="relog_query")
+        with col2:
+            portion = st.select_slider("Portion", options=[0.5, 0.75, 1.0, 1.25, 1.5, 2.0], value=1.0,
+                                       format_func=lambda p: f"×{p:g}", key="relog_portion")
+
+        matches = index.search(query)
+        if not matches:
+            st.caption("No past meals match that search.")
+        for i, meal in enumerate(matches):
+            kcal = int(meal.nutrients.calories * portion)
+            label = f"{meal.name} · {kcal} kcal · logged {meal.count}×"
+            if st.button(label, key=f"relog_{i}", use_container_width=True, disabled=bool(pending_writes())) \
+                    and not pending_writes():
+                entry = relog_meal(user_id, meal, portion)
+                if entry:
+                    st.toast(f"Logged: **{entry.meal_name}** ({int(entry.nutrients.calories)} kcal)", icon="⚡")
+                    st.session_state.active_tab = "Dashboard"
+                    st.rerun()
+
+def render_batch_logger():
+    """Logs several meals (e.g. a whole day) with one AI call and one sheet append."""
+    with st.container(border=True):
+        st.markdown('<h2 style="margin-top:0; font-size: 2rem;">Batch Log 🍱</h2>', unsafe_allow_html=True)
+        st.markdown('<p style="color:#94a3b8; margin-bottom: 2rem;">Catching up on the day? Describe each meal and AI analyzes them all in one go.</p>', unsafe_allow_html=True)
+
+        n_meals = st.number_input("Number of meals", min_value=2, max_value=8, value=3, step=1)
+        meals = []
+        for i in range(int(n_meals)):
+            col1, col2 = st.columns([1.5, 1], gap="large")
+            with col1:
+                desc = st.text_area(f"Meal {i+1}", height=90, key=f"batch_desc_{i}", placeholder="E.g. Greek yogurt with berries...")
+            with col2:
+                photo = st.file_uploader(f"Photo {i+1} (Optional)", type=["jpg", "jpeg", "png"], key=f"batch_img_{i}")
+            meals.append((desc, photo))
+
+        submit = st.button("Log & Analyze All Meals", use_container_width=True, type="primary", disabled=bool(pending_writes()))
+
+    if submit and not pending_writes(): # also covers a button rendered before a save failed this run
+        meals = [(d, f) for d, f in meals if d or f]
+        if not meals:
+            st.error("Please describe at least one meal.")
+            return
+
+        with st.spinner(f"🤖 AI is analyzing {len(meals)} meals..."):
+            images = []
+            lines = []
+            for i, (desc, photo) in enumerate(meals):
+                note = ""
+                if photo:
+                    try:
+                        images.append(Image.open(photo))
+                    except:
+                        st.error(f"Invalid Image File for meal {i+1}")
+                        return
+                    note = f" (see photo #{len(images)})"
+                lines.append(f"{i+1}. '{desc or 'Meal in photo'}'{note}")
+
+            meal_list = "\n".join(lines)
+            full_prompt = f"""
+            Analyze each of these {len(meals)} meals separately, one array item per meal in the same order ({NUTRIENT_UNITS_HINT}):
+            {meal_list}
+            Meal_Name should be a short, fun summary (e.g. "Avocado Toast").
+            """
+
+            data, error = request_structured(full_prompt, NUTRITION_BATCH_SCHEMA, images, expected_len=len(meals))
+            if error:
+                st.error(error)
+                return
+
+            user_id = st.session_state.user.user_id
+            entries = [build_log_entry(d, user_id) for d in data]
+            if not log_foods_to_sheet(user_id, entries):
+                return
+            apply_logs_optimistically(user_id, entries)
+
+            total_kcal = int(sum(e.nutrients.calories for e in entries))
+            st.toast(f"Logged {len(entries)} meals ({total_kcal} kcal)", icon="🎉")
+            st.session_state.active_tab = "Dashboard"
+            st.rerun()
+
 def render_leaderboard():
     st.title("Global Arena Sync 🔥")
     
     # FETCH REAL DATA
-    users = fetch_all_users()
+    users = [UserProfile.from_record(r) for r in prefetched('leaderboard', fetch_all_users)]
     if not users:
         st.warning("No users found or database not connected. Please check secrets.")
         return
 
-    # Filter/Sort
-    for u in users:
-        u['Rank_Points_Counter'] = safe_int(u.get('Rank_Points_Counter', 0))
-            
-    leaderboard_data = sorted(users, key=lambda x: x['Rank_Points_Counter'], reverse=True)
+    # Sort
+    me = st.session_state.user
+    leaderboard_data = sorted(users, key=lambda x: x.rank_points, reverse=True)
     
     # Update: Added Daily Quest Card
     st.markdown("""
@@ -727,20 +2000,20 @@ def render_leaderboard():
     <div style="display: flex; gap: 1rem; margin-bottom: 2rem;">
         <div class="glass-card" style="flex: 1; text-align: center;">
             <p style="font-size: 0.75rem; font-weight: 800; color: #64748b; text-transform: uppercase;">Weekly Wins</p>
-            <p style="font-size: 2rem; font-weight: 900; color: {ACCENT_AMBER};">{st.session_state.user.get('Total_Weekly_Wins', 0)}</p>
+            <p style="font-size: 2rem; font-weight: 900; color: {ACCENT_AMBER};">{me.weekly_wins}</p>
         </div>
         <div class="glass-card" style="flex: 1; text-align: center;">
             <p style="font-size: 0.75rem; font-weight: 800; color: #64748b; text-transform: uppercase;">Rank Points</p>
-            <p style="font-size: 1.5rem; font-weight: 800; color: {ACCENT_EMERALD}; text-transform: uppercase;">{st.session_state.user.get('Rank_Points_Counter', 0)} PTS</p>
+            <p style="font-size: 1.5rem; font-weight: 800; color: {ACCENT_EMERALD}; text-transform: uppercase;">{me.rank_points} PTS</p>
         </div>
     </div>
     """, unsafe_allow_html=True)
     
     for i, p in enumerate(leaderboard_data):
-        username = p.get('Username', 'Unknown')
-        is_me = username == st.session_state.user['Username']
-        rank_pts = p.get('Rank_Points_Counter', 0)
-        tier = p.get('Current_Rank_Tier', 'Bronze')
+        username = p.username
+        is_me = username == me.username
+        rank_pts = p.rank_points
+        tier = p.rank_tier
         
         border = f"1px solid {ACCENT_INDIGO}" if is_me else "1px solid rgba(51, 65, 85, 0.5)"
         bg = "rgba(99, 102, 241, 0.1)" if is_me else "rgba(30, 41, 59, 0.3)"
@@ -752,7 +2025,7 @@ def render_leaderboard():
         <div style="background: {bg}; border: {border}; border-radius: 1.5rem; padding: 1.5rem; margin-bottom: 1rem; display: flex; align-items: center; justify-content: space-between;">
             <div style="display: flex; align-items: center; gap: 1rem;">
                 <span style="font-size: 1.5rem; font-weight: 900; color: #475569; width: 30px;">#{i+1}</span>
-                <img src="https://api.dicebear.com/7.x/avataaars/svg?seed={username}" style="width: 50px; height: 50px; border-radius: 12px; object-fit: cover;">
+                <img src="{avatar_data_uri(username)}" style="width: 50px; height: 50px; border-radius: 12px; object-fit: cover;">
                 <div>
                     <h4 style="margin: 0; font-size: 1.1rem;">{username} { '(You)' if is_me else ''}</h4>
                     <span style="font-size: 0.7rem; font-weight: 800; text-transform: uppercase; color: {t_color};">{tier}</span>
@@ -788,36 +2061,34 @@ def render_profile_settings():
             <div style="background: rgba(99, 102, 241, 0.05); border: 1px solid rgba(99, 102, 241, 0.2); border-radius: 1rem; padding: 1rem; display: flex; align-items: center; justify-content: space-between; margin-bottom: 2rem;">
                 <div>
                     <h4 style="color: #818cf8; font-size: 0.8rem; text-transform: uppercase; margin: 0;">AI Nutritionist Assessment</h4>
-                    <p style="font-size: 0.75rem; color: #94a3b8; margin: 0;">Auto-calculate based on: {user.get('Age')}y / {user.get('Weight')} {user.get('Measurement_System')} / {user.get('Primary_Directive')}</p>
+                    <p style="font-size: 0.75rem; color: #94a3b8; margin: 0;">Auto-calculate based on: {user.age}y / {user.weight:g} {user.measurement_system} / {user.primary_directive}</p>
                 </div>
             </div>
             """, unsafe_allow_html=True)
             
+            refine = st.checkbox("Refine with AI Nutritionist", help="Sends the calculated baseline to Gemini for adjustment. Slower and uses an API call.")
             if st.button("🤖 Auto-Tune Targets"):
+                new_targets = calculate_targets(user)
+                if not refine:
+                    st.session_state.user.apply_goals(new_targets)
+                    st.toast("Targets calculated. Review and commit below.", icon="🎯") # toasts survive the rerun
+                    st.rerun()
+
                 with st.spinner("Calculating optimal biometrics..."):
-                    w_kg = safe_float(user.get('Weight', 70))
-                    h_cm = safe_float(user.get('Height', 170))
-                    if user.get('Measurement_System') == 'imperial':
-                        w_kg = w_kg * 0.453
-                        h_cm = h_cm * 2.54
+                    w_kg, h_cm = body_metrics_metric(user)
                     
                     prompt = f"""
-                    User: Age {user.get('Age')}, Gender {user.get('Gender')}, Weight {w_kg}kg, Height {h_cm}cm, Activity {user.get('Activity_Level')}, Goal {user.get('Primary_Directive')}.
-                    Calculate daily targets. Return JSON:
-                    Calorie_Goal, Protein_Goal, Carbs_Goal, Saturated_Fat_Goal, Unsaturated_Fat_Goal, Fiber_Goal, Sugar_Goal, Sodium_Goal, Potassium_Goal, Iron_Goal.
+                    User: Age {user.age}, Gender {user.gender}, Weight {w_kg:.1f}kg, Height {h_cm:.1f}cm, Activity {user.activity_level}, Goal {user.primary_directive}.
+                    Baseline targets from Mifflin-St Jeor and reference intakes: {json.dumps(new_targets)}.
+                    Refine these daily targets where appropriate.
                     """
-                    res = get_gemini_response(prompt, json_mode=True)
-                    if res.startswith("ERROR"):
-                        st.error(res)
-                    elif res:
-                        try:
-                            clean_res = res.replace("```json", "").replace("```", "")
-                            new_targets = json.loads(clean_res)
-                            st.session_state.user.update(new_targets)
-                            st.success("Targets updated by AI.")
-                            st.rerun()
-                        except:
-                            st.error("AI output invalid.")
+                    refined, error = request_structured(prompt, TARGETS_SCHEMA)
+                    if error:
+                        st.error("AI output invalid." if error.startswith("Failed to parse") else error)
+                    else:
+                        st.session_state.user.apply_goals(refined)
+                        st.toast("Targets updated by AI.", icon="🤖")
+                        st.rerun()
 
     # Form Mode
     if edit_mode:
@@ -826,32 +2097,31 @@ def render_profile_settings():
             c1, c2, c3 = st.columns(3)
             
             new_goals = {}
-            new_goals['Calorie_Goal'] = c1.number_input("Calories (kcal)", value=int(safe_float(user.get('Calorie_Goal', 2000))))
-            new_goals['Protein_Goal'] = c2.number_input("Protein (g)", value=int(safe_float(user.get('Protein_Goal', 150))))
-            new_goals['Carbs_Goal'] = c3.number_input("Carbs (g)", value=int(safe_float(user.get('Carbs_Goal', 200))))
+            new_goals['Calorie_Goal'] = c1.number_input("Calories (kcal)", value=int(user.goals.calories))
+            new_goals['Protein_Goal'] = c2.number_input("Protein (g)", value=int(user.goals.protein))
+            new_goals['Carbs_Goal'] = c3.number_input("Carbs (g)", value=int(user.goals.carbs))
             
             c4, c5 = st.columns(2)
-            new_goals['Saturated_Fat_Goal'] = c4.number_input("Sat. Fat (g)", value=int(safe_float(user.get('Saturated_Fat_Goal', 20))))
-            new_goals['Unsaturated_Fat_Goal'] = c5.number_input("Unsat. Fat (g)", value=int(safe_float(user.get('Unsaturated_Fat_Goal', 50))))
+            new_goals['Saturated_Fat_Goal'] = c4.number_input("Sat. Fat (g)", value=int(user.goals.saturated_fat))
+            new_goals['Unsaturated_Fat_Goal'] = c5.number_input("Unsat. Fat (g)", value=int(user.goals.unsaturated_fat))
 
             st.markdown("<br><h4 style='font-size: 0.75rem; color: #64748b; text-transform: uppercase; letter-spacing: 0.1em; margin-bottom: 1rem;'>Micronutrient Profile</h4>", unsafe_allow_html=True)
             m1, m2, m3 = st.columns(3)
-            new_goals['Fiber_Goal'] = m1.number_input("Fiber (g)", value=int(safe_float(user.get('Fiber_Goal', 25))))
-            new_goals['Sugar_Goal'] = m2.number_input("Sugar (g)", value=int(safe_float(user.get('Sugar_Goal', 30))))
-            new_goals['Sodium_Goal'] = m3.number_input("Sodium (mg)", value=int(safe_float(user.get('Sodium_Goal', 2000))))
+            new_goals['Fiber_Goal'] = m1.number_input("Fiber (g)", value=int(user.goals.fiber))
+            new_goals['Sugar_Goal'] = m2.number_input("Sugar (g)", value=int(user.goals.sugar))
+            new_goals['Sodium_Goal'] = m3.number_input("Sodium (mg)", value=int(user.goals.sodium))
             
             m4, m5 = st.columns(2)
-            new_goals['Potassium_Goal'] = m4.number_input("Potassium (mg)", value=int(safe_float(user.get('Potassium_Goal', 3500))))
-            new_goals['Iron_Goal'] = m5.number_input("Iron (mg)", value=int(safe_float(user.get('Iron_Goal', 15))))
+            new_goals['Potassium_Goal'] = m4.number_input("Potassium (mg)", value=int(user.goals.potassium))
+            new_goals['Iron_Goal'] = m5.number_input("Iron (mg)", value=int(user.goals.iron))
 
             st.write("")
             submitted = st.form_submit_button("Commit Changes & Sync", type="primary")
             if submitted:
-                success = update_user_targets_db(user['User_ID'], new_goals)
+                success = update_user_targets_db(user.user_id, new_goals)
                 if success:
-                    st.success("Profile Synced to Database.")
-                    time.sleep(1)
-                    st.rerun()
+                    # Session profile is already updated in place; no reload needed
+                    st.toast("Profile Synced to Database.", icon="✅")
                 else:
                     st.error("Sync Failed.")
     else:
@@ -867,21 +2137,21 @@ def render_profile_settings():
                 </div>
                 """, unsafe_allow_html=True)
         
-        display_field(c1, "Calories", safe_int(user.get('Calorie_Goal')), "kcal")
-        display_field(c2, "Protein", safe_int(user.get('Protein_Goal')), "g")
-        display_field(c3, "Carbs", safe_int(user.get('Carbs_Goal')), "g")
+        display_field(c1, "Calories", int(user.goals.calories), "kcal")
+        display_field(c2, "Protein", int(user.goals.protein), "g")
+        display_field(c3, "Carbs", int(user.goals.carbs), "g")
         c4, c5 = st.columns(2)
-        display_field(c4, "Sat. Fat", safe_int(user.get('Saturated_Fat_Goal')), "g")
-        display_field(c5, "Unsat. Fat", safe_int(user.get('Unsaturated_Fat_Goal')), "g")
+        display_field(c4, "Sat. Fat", int(user.goals.saturated_fat), "g")
+        display_field(c5, "Unsat. Fat", int(user.goals.unsaturated_fat), "g")
 
         st.markdown("<br><h4 style='font-size: 0.75rem; color: #64748b; text-transform: uppercase; letter-spacing: 0.1em; margin-bottom: 1rem;'>Micronutrient Profile</h4>", unsafe_allow_html=True)
         m1, m2, m3 = st.columns(3)
-        display_field(m1, "Fiber", safe_int(user.get('Fiber_Goal')), "g")
-        display_field(m2, "Sugar", safe_int(user.get('Sugar_Goal')), "g")
-        display_field(m3, "Sodium", safe_int(user.get('Sodium_Goal')), "mg")
+        display_field(m1, "Fiber", int(user.goals.fiber), "g")
+        display_field(m2, "Sugar", int(user.goals.sugar), "g")
+        display_field(m3, "Sodium", int(user.goals.sodium), "mg")
         m4, m5 = st.columns(2)
-        display_field(m4, "Potassium", safe_int(user.get('Potassium_Goal')), "mg")
-        display_field(m5, "Iron", safe_int(user.get('Iron_Goal')), "mg")
+        display_field(m4, "Potassium", int(user.goals.potassium), "mg")
+        display_field(m5, "Iron", int(user.goals.iron), "mg")
 
     st.markdown("</div>", unsafe_allow_html=True)
 
@@ -906,7 +2176,7 @@ def render_login():
                 if username and password:
                     try:
                         # 1. GET ALL USERS FROM SHEET
-                        all_users = fetch_all_users()
+                        all_users = fetch_all_users(LOGIN_COLUMNS, use_cache=False) # credentials never go to the shared cache
                         
                         # 2. FIND THE MATCH
                         found_user = None
@@ -916,7 +2186,13 @@ def render_login():
                                 # APPROVAL CHECK
                                 approved_status = str(user.get("Approved", "No")).lower()
                                 if "y" in approved_status:
-                                    found_user = user
+                                    found_user = fetch_verified_user_record(user)
+                                    if not found_user:
+                                        st.error("Could not load your profile (the user sheet may have changed). Please try again.")
+                                        found_user = None
+                                    else:
+                                        # Today's logs and leaderboard warm up while the dashboard renders
+                                        start_prefetch(user.get("User_ID"))
                                     break
                                 else:
                                     st.error("ACCESS DENIED: Account awaiting admin approval.")
@@ -925,11 +2201,10 @@ def render_login():
                         
                         # 3. SUCCESS
                         if found_user:
-                            st.success(f"Welcome back, {username}!")
+                            st.toast(f"Welcome back, {username}!", icon="⚡")
                             st.session_state.authenticated = True
-                            st.session_state.user = found_user
+                            st.session_state.user = UserProfile.from_record(found_user)
                             st.session_state.active_tab = "Dashboard"
-                            time.sleep(1)
                             st.rerun()
                         elif not any(str(u.get("Username")) == username for u in all_users):
                              st.error("ACCESS DENIED: Incorrect Username or Password.")
@@ -959,6 +2234,121 @@ def render_login():
 # 6. APP ORCHESTRATION
 # -----------------------------------------------------------------------------
 
+# PROFILER
+# Opt-in per-session profiling of the next N script runs, from the Diagnostics sidebar.
+# While no profile is armed, profiled_main() costs a single session-state lookup.
+
+PROFILE_SAMPLE_INTERVAL = 0.005 # seconds between stack samples
+
+def start_profile():
+    """on_change for the profiler toggle: arms a fresh profile, or stops the running one."""
+    if st.session_state.profiler_on:
+        st.session_state.profiler = {
+            'mode': st.session_state.profiler_mode, 'remaining': st.session_state.profiler_runs,
+            'runs': 0, 'wall': 0.0, 'stats': None, 'stacks': Counter(), 'samples': 0,
+        }
+    elif st.session_state.get('profiler'):
+        st.session_state.profiler['remaining'] = 0
+
+def sample_stacks(thread_id, root_code, profile, stop):
+    """Sampling loop: records the script thread's stack (from main() down) in collapsed-stack form."""
+    while not stop.wait(PROFILE_SAMPLE_INTERVAL):
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            stack.append(f"{frame.f_globals.get('__name__', '?')}.{frame.f_code.co_name}")
+            if frame.f_code is root_code:
+                break
+            frame = frame.f_back
+        if frame is None:
+            continue # Outside main(), e.g. before the script body reached it
+        profile['stacks'][";".join(reversed(stack))] += 1
+        profile['samples'] += 1
+
+def profiled_main():
+    """Runs main(), under cProfile or the stack sampler while this session has an armed profile."""
+    profile = st.session_state.get('profiler')
+    if not profile or not profile['remaining']:
+        return main()
+
+    profile['remaining'] -= 1
+    started = time.perf_counter()
+    if profile['mode'] == "Sampling":
+        stop = threading.Event()
+        sampler = threading.Thread(
+            target=sample_stacks, args=(threading.get_ident(), main.__code__, profile, stop), daemon=True
+        )
+        sampler.start()
+        try:
+            return main()
+        finally: # st.rerun() leaves main() via an exception; the run still counts
+            stop.set()
+            sampler.join()
+            profile['runs'] += 1
+            profile['wall'] += time.perf_counter() - started
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError: # Another profiler already owns the interpreter (Python 3.12+)
+        return main()
+    try:
+        return main()
+    finally:
+        profiler.disable()
+        if profile['stats'] is None:
+            profile['stats'] = pstats.Stats(profiler)
+        else:
+            profile['stats'].add(profiler)
+        profile['runs'] += 1
+        profile['wall'] += time.perf_counter() - started
+
+def profile_breakdown(profile):
+    """Inclusive seconds per render_* function, plus time spent in Sheets (gspread) and Gemini calls."""
+    totals = Counter()
+    sheets_dir = os.sep + "gspread" + os.sep
+    if profile['stats'] is not None:
+        for (filename, _, name), (_, _, _, cumtime, callers) in profile['stats'].stats.items():
+            if filename == __file__ and name.startswith('render_'):
+                totals[name] += cumtime
+            elif filename == __file__ and name == 'get_gemini_response':
+                totals['Gemini calls'] += cumtime
+            elif sheets_dir in filename:
+                # Only count entry points into gspread, so nested gspread calls aren't double counted
+                totals['Sheets calls'] += sum(edge[3] for caller, edge in callers.items() if sheets_dir not in caller[0])
+    elif profile['samples']:
+        per_sample = profile['wall'] / profile['samples']
+        for stack, count in profile['stacks'].items():
+            frames = stack.split(";")
+            for name in {f.split(".")[-1] for f in frames if f.startswith("__main__.render_")}:
+                totals[name] += count * per_sample
+            if "__main__.get_gemini_response" in frames:
+                totals['Gemini calls'] += count * per_sample
+            if any(f.startswith("gspread.") for f in frames):
+                totals['Sheets calls'] += count * per_sample
+    return totals.most_common()
+
+def render_profiler_panel():
+    with st.expander("⏱️ Profiler"):
+        st.radio("Mode", ["cProfile", "Sampling"], key="profiler_mode", horizontal=True)
+        st.number_input("Reruns to profile", min_value=1, max_value=50, value=5, key="profiler_runs")
+        st.toggle("Profile next reruns", key="profiler_on", on_change=start_profile)
+
+        profile = st.session_state.get('profiler')
+        if not profile or not profile['runs']:
+            return
+        st.caption(f"{profile['runs']} reruns profiled ({profile['remaining']} to go) · {profile['wall']:.2f}s total")
+        for name, seconds in profile_breakdown(profile):
+            st.caption(f"`{name}` {seconds * 1000:.0f} ms")
+
+        if profile['stats'] is not None:
+            st.download_button("Download .pstats", marshal.dumps(profile['stats'].stats),
+                               file_name="nutricomp.pstats", mime="application/octet-stream")
+        else:
+            collapsed = "\n".join(f"{stack} {count}" for stack, count in profile['stacks'].items())
+            st.download_button("Download collapsed stacks", collapsed,
+                               file_name="nutricomp.collapsed.txt", mime="text/plain")
+
 def main():
     if not st.session_state.user:
         render_login()
@@ -987,9 +2377,19 @@ def main():
             st.markdown("---")
             if st.button("Logout"):
                 st.session_state.user = None
+                st.session_state.pop('prefetch', None)
+                st.session_state.pop('today_logs', None)
+                st.session_state.pop('meal_index', None)
                 st.rerun()
             st.markdown("---")
             st.subheader("🔧 Diagnostics")
+            stats = gemini_stats()
+            if stats['calls']:
+                st.caption(
+                    f"Gemini this session: {stats['calls']} calls · avg {stats['latency_s'] / stats['calls']:.1f}s · "
+                    f"{stats['prompt_tokens']} prompt / {stats['output_tokens']} output tokens · "
+                    f"{stats['parse_failures']} failed parses ({stats['repairs']} repairs) · {stats['hedges']} hedged"
+                )
             if st.button("Test AI Connection"):
                 try:
                     # Force the key from secrets
@@ -1005,6 +2405,7 @@ def main():
                     st.code(model_names)
                 except Exception as e:
                     st.error(f"❌ Connection Failed: {e}")
+            render_profiler_panel()
 
         if st.session_state.active_tab == "Dashboard":
             render_dashboard()
@@ -1016,4 +2417,4 @@ def main():
             render_profile_settings()
 
 if __name__ == "__main__":
-    main()
+    profiled_main()
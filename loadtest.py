@@ -0,0 +1,501 @@
+"""
+NutriComp load generator.
+
+Drives N concurrent simulated sessions through login -> dashboard -> meal logging -> leaderboard
+using Streamlit's AppTest. Google Sheets and Gemini are replaced by in-memory fakes that have
+configurable latency and per-minute quotas. The report gives p50/p95/p99 per flow, upstream
+call counts and peak memory. With --cache-backend redis and no --redis-url, the app's Redis
+client talks to a small in-process RESP stand-in.
+
+    python loadtest.py --sessions 200 --concurrency 50 --sheets-latency 250 --gemini-latency 2500
+"""
+
+import argparse
+import json
+import os
+import re
+import resource
+import socketserver
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from unittest.mock import MagicMock
+
+import gspread
+import requests
+import streamlit
+from google.oauth2.service_account import Credentials
+from streamlit.components.v2.component_manager import BidiComponentManager
+from streamlit.runtime import Runtime
+from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+from streamlit.runtime.dataframe_source_manager import DataframeSourceManager
+from streamlit.runtime.media_file_manager import MediaFileManager
+from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+from streamlit.runtime.secrets import Secrets
+from streamlit.testing.v1 import AppTest, app_test
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+NUTRIENT_KEYS = ['Calories', 'Protein', 'Carbs', 'Saturated_Fat', 'Unsaturated_Fat', 'Fiber', 'Sugar', 'Sodium', 'Potassium', 'Iron']
+GOAL_KEYS = ['Calorie_Goal', 'Protein_Goal', 'Carbs_Goal', 'Saturated_Fat_Goal', 'Unsaturated_Fat_Goal', 'Fiber_Goal', 'Sugar_Goal', 'Sodium_Goal', 'Potassium_Goal', 'Iron_Goal']
+USER_HEADERS = (
+    ['User_ID', 'Username', 'Password'] + GOAL_KEYS
+    + ['Current_Rank_Tier', 'Current_Rank_Multiplier', 'Rank_Points_Counter', 'Total_Weekly_Wins', 'Daily_Points']
+    + ['Age', 'Gender', 'Weight', 'Height', 'Activity_Level', 'Primary_Directive', 'Measurement_System', 'Approved']
+)
+LOG_HEADERS = ['Log_ID', 'Timestamp', 'Date_Ref', 'User_ID', 'Meal_Name'] + NUTRIENT_KEYS
+
+# -----------------------------------------------------------------------------
+# 1. UPSTREAM ACCOUNTING
+# -----------------------------------------------------------------------------
+
+class Upstream:
+    """Shared latency, quota and call accounting for one fake service."""
+
+    def __init__(self, name, latency_ms, quota_per_min):
+        self.name = name
+        self.latency = latency_ms / 1000.0
+        self.quota = quota_per_min
+        self.calls = Counter()
+        self._window = deque()
+        self._lock = threading.Lock()
+
+    def call(self, op):
+        """Counts the call, applies latency and returns False if the per-minute quota is exhausted."""
+        now = time.monotonic()
+        with self._lock:
+            self.calls[op] += 1
+            while self._window and now - self._window[0] > 60:
+                self._window.popleft()
+            if self.quota and len(self._window) >= self.quota:
+                self.calls["quota_rejected"] += 1
+                return False
+            self._window.append(now)
+        if self.latency:
+            time.sleep(self.latency)
+        return True
+
+def quota_error(op):
+    """The gspread.exceptions.APIError a real 429 from the Sheets API produces."""
+    kind = "Write" if op.split(".")[-1].startswith(("append", "update")) else "Read"
+    response = requests.Response()
+    response.status_code = 429
+    response._content = json.dumps({"error": {
+        "code": 429,
+        "message": f"Quota exceeded for quota metric '{kind} requests' and limit '{kind} requests per minute per user'",
+        "status": "RESOURCE_EXHAUSTED",
+    }}).encode("utf-8")
+    return gspread.exceptions.APIError(response)
+
+# -----------------------------------------------------------------------------
+# 2. FAKE GOOGLE SHEETS
+# -----------------------------------------------------------------------------
+
+class FakeCell:
+    def __init__(self, row, col):
+        self.row = row
+        self.col = col
+
+class FakeWorksheet:
+    """The subset of gspread.Worksheet that app.py uses, backed by a list of rows."""
+
+    def __init__(self, upstream, title, headers, sheet_id):
+        self.upstream = upstream
+        self.title = title
+        self.id = sheet_id
+        self.rows = [list(headers)]
+        self._lock = threading.Lock()
+
+    def _call(self, op):
+        if not self.upstream.call(f"{self.title}.{op}"):
+            raise quota_error(op)
+
+    def row_values(self, row, **kwargs):
+        self._call("row_values")
+        with self._lock:
+            values = list(self.rows[row - 1]) if row <= len(self.rows) else []
+        while values and values[-1] == "":
+            values.pop()
+        return values
+
+    def batch_get(self, ranges, major_dimension=None, **kwargs):
+        self._call("batch_get")
+        out = []
+        with self._lock:
+            for rng in ranges:
+                m = re.match(r"([A-Z]+)(\d+):([A-Z]+)", rng)
+                col = 0
+                for ch in m.group(1):
+                    col = col * 26 + ord(ch) - 64
+                start = int(m.group(2))
+                values = [r[col - 1] if col - 1 < len(r) else "" for r in self.rows[start - 1:]]
+                while values and values[-1] == "":
+                    values.pop()
+                out.append([values] if values else [])
+        return out
+
+    def get_all_records(self, **kwargs):
+        self._call("get_all_records")
+        with self._lock:
+            headers = self.rows[0]
+            return [dict(zip(headers, r)) for r in self.rows[1:]]
+
+    def append_row(self, row, **kwargs):
+        self.append_rows([row], **kwargs)
+
+    def append_rows(self, rows, **kwargs):
+        self._call("append_rows")
+        with self._lock:
+            self.rows.extend(list(r) for r in rows)
+
+    def find(self, value, **kwargs):
+        self._call("find")
+        with self._lock:
+            for r, row in enumerate(self.rows, start=1):
+                for c, cell in enumerate(row, start=1):
+                    if str(cell) == str(value):
+                        return FakeCell(r, c)
+        return None
+
+    def update_cell(self, row, col, value):
+        self._call("update_cell")
+        with self._lock:
+            self.rows[row - 1][col - 1] = value
+
+class FakeSpreadsheet:
+    def __init__(self, upstream, n_users):
+        self.id = "fake"
+        self.sheet1 = FakeWorksheet(upstream, "Users", USER_HEADERS, 0)
+        self.logs = FakeWorksheet(upstream, "Food_Logs", LOG_HEADERS, 1)
+        today = datetime.now().strftime("%Y-%m-%d")
+        for i in range(n_users):
+            self.sheet1.rows.append(
+                [f"u_{i:05d}", f"user{i}", f"pw{i}"]
+                + [2000, 150, 200, 20, 50, 30, 30, 2300, 3500, 18]
+                + ["Bronze", 1.0, (i * 37) % 600, i % 5, 0]
+                + [30, "Female" if i % 2 else "Male", 70, 175, 1.375, "Maintain", "metric", "Yes"]
+            )
+            self.logs.rows.append(
+                [f"l_seed{i:05d}", f"{today} 08:00:00", today, f"u_{i:05d}", "Oatmeal", 350, 12, 60, 2, 5, 8, 10, 150, 300, 3]
+            )
+
+    def worksheet(self, title):
+        if title == "Food_Logs":
+            return self.logs
+        raise gspread.exceptions.WorksheetNotFound(title)
+
+class FakeClient:
+    def __init__(self, spreadsheet):
+        self.spreadsheet = spreadsheet
+
+    def open_by_key(self, key):
+        return self.spreadsheet
+
+# -----------------------------------------------------------------------------
+# 3. FAKE GEMINI
+# -----------------------------------------------------------------------------
+
+class FakeResponse:
+    def __init__(self, status_code, body=None, text="", chunks=None):
+        self.status_code = status_code
+        self._body = body
+        self.text = text or json.dumps(body)
+        self._chunks = chunks or []
+
+    def json(self):
+        return self._body
+
+    def iter_lines(self, decode_unicode=False):
+        for chunk in self._chunks:
+            yield f"data: {json.dumps(chunk)}"
+
+def fake_meal(seed):
+    return {"Meal_Name": f"Test Meal {seed}", "Calories": 500, "Protein": 30, "Carbs": 55, "Saturated_Fat": 5,
+            "Unsaturated_Fat": 12, "Fiber": 7, "Sugar": 9, "Sodium": 600, "Potassium": 700, "Iron": 4}
+
+def make_fake_post(upstream):
+    def fake_post(url, **kwargs):
+        body = kwargs["json"]
+        streaming = "streamGenerateContent" in url
+        if not upstream.call("streamGenerateContent" if streaming else "generateContent"):
+            return FakeResponse(429, {"error": {"code": 429, "status": "RESOURCE_EXHAUSTED"}})
+
+        prompt = body["contents"][0]["parts"][0]["text"]
+        config = body.get("generationConfig", {})
+        schema = config.get("responseSchema") or config.get("response_schema") or {}
+        count = re.search(r"each of these (\d+) meals", prompt)
+        if "Calorie_Goal" in prompt or "Calorie_Goal" in schema.get("properties", {}):
+            payload = {k: v for k, v in zip(GOAL_KEYS, [2100, 140, 230, 22, 48, 30, 45, 2300, 3400, 8])}
+        elif count or str(schema.get("type", "")).upper() == "ARRAY":
+            payload = [fake_meal(i) for i in range(int(count.group(1)) if count else 1)]
+        else:
+            payload = fake_meal(0)
+        text = json.dumps(payload)
+        usage = {"promptTokenCount": len(prompt) // 4, "candidatesTokenCount": len(text) // 4}
+
+        if streaming:
+            step = max(len(text) // 3, 1)
+            pieces = [text[i:i + step] for i in range(0, len(text), step)]
+            chunks = [{"candidates": [{"content": {"parts": [{"text": p}]}}]} for p in pieces]
+            chunks[-1]["usageMetadata"] = usage
+            return FakeResponse(200, chunks=chunks)
+        return FakeResponse(200, {"candidates": [{"content": {"parts": [{"text": text}]}}], "usageMetadata": usage})
+    return fake_post
+
+# -----------------------------------------------------------------------------
+# 4. LOCAL REDIS STAND-IN
+# -----------------------------------------------------------------------------
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    """Answers the RESP commands RedisCache sends: PING, AUTH, SELECT, GET, SET [EX], INCR."""
+
+    def handle(self):
+        while True:
+            try:
+                args = self.read_command()
+            except (ConnectionError, ValueError):
+                return
+            if args is None:
+                return
+            self.wfile.write(self.server.dispatch(args))
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            raise ValueError(f"expected a RESP array, got {line!r}")
+        args = []
+        for _ in range(int(line[1:-2])):
+            size = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(size + 2)[:-2])
+        return args
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    """In-process key/value server on localhost, so the redis cache backend runs without a real Redis."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeRedisHandler)
+        self.data = {} # key -> (value bytes, expires at or None)
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"redis://127.0.0.1:{self.server_address[1]}/0"
+
+    def lookup(self, key):
+        value, expires = self.data.get(key, (None, None))
+        if expires is not None and expires <= time.time():
+            self.data.pop(key, None)
+            return None
+        return value
+
+    def dispatch(self, args):
+        cmd = args[0].upper()
+        with self.lock:
+            if cmd in (b"PING", b"AUTH", b"SELECT"):
+                return b"+OK\r\n" if cmd != b"PING" else b"+PONG\r\n"
+            if cmd == b"GET":
+                value = self.lookup(args[1])
+                return b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value), value)
+            if cmd == b"SET":
+                ttl = int(args[4]) if len(args) >= 5 and args[3].upper() == b"EX" else None
+                self.data[args[1]] = (args[2], time.time() + ttl if ttl else None)
+                return b"+OK\r\n"
+            if cmd == b"INCR":
+                value = int(self.lookup(args[1]) or 0) + 1
+                self.data[args[1]] = (str(value).encode(), None)
+                return b":%d\r\n" % value
+        return b"-ERR unknown command '%s'\r\n" % cmd
+
+# -----------------------------------------------------------------------------
+# 5. SESSION FLOWS
+# -----------------------------------------------------------------------------
+
+def button(at, label):
+    return next(b for b in at.button if b.label == label)
+
+def install_shared_runtime(secrets):
+    """
+    AppTest swaps in a fresh mock Runtime singleton and st.secrets around every run and clears
+    them afterwards, which breaks sessions running concurrently. Install one shared runtime
+    (one cache storage, like a single server process) and global secrets instead, and hand
+    AppTest a subclass so its per-run assignments no longer touch the real singleton.
+    """
+    runtime = MagicMock(spec=Runtime)
+    runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+    runtime.dataframe_source_mgr = DataframeSourceManager()
+    runtime.cache_storage_manager = MemoryCacheStorageManager()
+    components = BidiComponentManager()
+    components.discover_and_register_components(start_file_watching=False)
+    runtime.bidi_component_registry = components
+    Runtime._instance = runtime
+    app_test.Runtime = type("PerRunRuntime", (Runtime,), {})
+
+    # Each run compiles app.py; CPython's compiler is not safe to enter from many threads at once
+    compile_lock = threading.Lock()
+    get_bytecode = ScriptCache.get_bytecode
+    def locked_get_bytecode(self, script_path):
+        with compile_lock:
+            return get_bytecode(self, script_path)
+    ScriptCache.get_bytecode = locked_get_bytecode
+
+    shared = Secrets()
+    shared._secrets = secrets
+    streamlit.secrets = shared
+
+def run_session(i, n_users, timeout, results):
+    """One simulated user: login, dashboard, log a meal, open the leaderboard."""
+    u = i % n_users
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+
+    def timed(flow, action):
+        """A flow counts as failed if it raised or the app rendered an exception or st.error."""
+        start = time.perf_counter()
+        try:
+            action()
+            ok = not at.exception and not at.error
+        except Exception:
+            ok = False
+        results[flow].append((time.perf_counter() - start, ok))
+        return ok
+
+    def login():
+        at.run()
+        at.text_input(key="login_user").input(f"user{u}")
+        at.text_input(key="login_pass").input(f"pw{u}")
+        button(at, "Authorize Session").click().run()
+
+    def dashboard():
+        at.button(key="nav_Dashboard").click().run()
+
+    def log_meal():
+        at.button(key="nav_Log Food").click().run()
+        area = next(t for t in at.text_area if t.label == "Meal Description")
+        area.input("Chicken burrito bowl with rice and beans")
+        button(at, "Log & Analyze Meal").click().run()
+
+    def leaderboard():
+        at.button(key="nav_Arena Sync").click().run()
+
+    if not timed("login", login) or at.session_state["user"] is None:
+        return
+    timed("dashboard", dashboard)
+    timed("log_meal", log_meal)
+    timed("leaderboard", leaderboard)
+
+# -----------------------------------------------------------------------------
+# 6. REPORT
+# -----------------------------------------------------------------------------
+
+def percentile(sorted_vals, p):
+    if not sorted_vals:
+        return 0.0
+    idx = min(int(round(p / 100.0 * (len(sorted_vals) - 1))), len(sorted_vals) - 1)
+    return sorted_vals[idx]
+
+def build_report(results, sheets, gemini, wall, peak_traced, args):
+    peak_traced_mb = round(peak_traced / 2**20, 1) if peak_traced is not None else None
+    flows = {}
+    for flow, samples in results.items():
+        times = sorted(t for t, ok in samples if ok)
+        flows[flow] = {
+            "count": len(samples),
+            "errors": sum(1 for _, ok in samples if not ok),
+            "p50_ms": round(percentile(times, 50) * 1000, 1),
+            "p95_ms": round(percentile(times, 95) * 1000, 1),
+            "p99_ms": round(percentile(times, 99) * 1000, 1),
+        }
+    return {
+        "config": vars(args),
+        "wall_seconds": round(wall, 2),
+        "flows": flows,
+        "upstream_calls": {"sheets": dict(sheets.calls), "gemini": dict(gemini.calls)},
+        "peak_traced_mb": peak_traced_mb,
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+def print_report(report):
+    print(f"\nSessions: {report['config']['sessions']}  concurrency: {report['config']['concurrency']}  wall: {report['wall_seconds']}s")
+    print("(percentiles over successful flows; sessions stop after a failed login)")
+    print(f"{'flow':<12}{'n':>6}{'err':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for flow, s in report["flows"].items():
+        print(f"{flow:<12}{s['count']:>6}{s['errors']:>6}{s['p50_ms']:>10}{s['p95_ms']:>10}{s['p99_ms']:>10}")
+    for service, calls in report["upstream_calls"].items():
+        total = sum(v for k, v in calls.items() if k != "quota_rejected")
+        print(f"\n{service}: {total} calls")
+        for op, n in sorted(calls.items()):
+            print(f"  {op:<28}{n:>8}")
+    traced = f"peak traced: {report['peak_traced_mb']} MB   " if report['peak_traced_mb'] is not None else ""
+    print(f"\nMemory: {traced}max RSS: {report['max_rss_mb']} MB")
+
+# -----------------------------------------------------------------------------
+# 7. ENTRY POINT
+# -----------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent session load test for NutriComp.")
+    parser.add_argument("--sessions", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--users", type=int, default=200, help="accounts seeded in the fake Users sheet")
+    parser.add_argument("--sheets-latency", type=float, default=150, help="ms per Sheets call")
+    parser.add_argument("--sheets-quota", type=int, default=0, help="Sheets calls per minute (0 = unlimited)")
+    parser.add_argument("--gemini-latency", type=float, default=1500, help="ms per Gemini call")
+    parser.add_argument("--gemini-quota", type=int, default=0, help="Gemini calls per minute (0 = unlimited)")
+    parser.add_argument("--cache-backend", default="sqlite", choices=["sqlite", "redis", "none"])
+    parser.add_argument("--redis-url", help="Redis server for --cache-backend redis (default: a local in-process stand-in)")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds per script run")
+    parser.add_argument("--trace-memory", action="store_true", help="tracemalloc peak (slows the run noticeably)")
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+
+    sheets = Upstream("sheets", args.sheets_latency, args.sheets_quota)
+    gemini = Upstream("gemini", args.gemini_latency, args.gemini_quota)
+    client = FakeClient(FakeSpreadsheet(sheets, args.users))
+
+    # Patch the libraries app.py reaches for; AppTest executes the script in this process.
+    gspread.authorize = lambda creds: client
+    Credentials.from_service_account_info = staticmethod(lambda info, scopes=None: object())
+    requests.post = make_fake_post(gemini)
+
+    secrets = {
+        "gcp_service_account": {"type": "service_account"},
+        "GEMINI_API_KEY": "fake-key",
+        "CACHE_BACKEND": args.cache_backend,
+        "CACHE_PATH": os.path.join(tempfile.mkdtemp(prefix="nutricomp-load-"), "cache.sqlite3"),
+    }
+    if args.cache_backend == "redis":
+        secrets["REDIS_URL"] = args.redis_url or FakeRedisServer().url
+
+    install_shared_runtime(secrets)
+
+    results = defaultdict(list)
+    if args.trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for f in [pool.submit(run_session, i, args.users, args.timeout, results) for i in range(args.sessions)]:
+            f.result()
+    wall = time.perf_counter() - start
+    peak = None
+    if args.trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    report = build_report(results, sheets, gemini, wall, peak, args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump(report, fh, indent=2)
+
+if __name__ == "__main__":
+    main()